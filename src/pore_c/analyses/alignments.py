@@ -1,23 +1,31 @@
 import logging
 import sys
-from itertools import combinations
+from itertools import repeat
 from pathlib import Path
+from typing import Union
 
-import networkx as nx
 import numpy as np
 import pandas as pd
 from streamz import Stream
 from tqdm import tqdm
 
 from pore_c.datasources import NameSortedBamSource
-from pore_c.io import TableWriter
-from pore_c.model import BamEntryDf, FragmentDf, PoreCAlignDf, PoreCReadDf
-from pore_c.utils import DataFrameProgress
+from pore_c.io import TableWriter, ThreadedWriter
+from pore_c.model import BamEntryDf, FragmentDf, GenomeIntervalIndex, PoreCAlignDf, PoreCReadDf
+from pore_c.utils import DataFrameProgress, memory_based_chunksize
 
 logger = logging.getLogger(__name__)
 
 FILTER_REASON_DTYPE = PoreCAlignDf.DTYPE["reason"]
 
+# rough in-memory size of a read with its alignments and fragment overlaps while being filtered. Measured
+# with tracemalloc on tests/data/test_ns.sam (3.5 alignments per read): the batch itself takes ~0.3KB per
+# read and filter_read_alignments peaks at a further ~1.6KB per read, rounded up to 2KB.
+READ_BYTES_ESTIMATE = 2048
+
+# zstd level for the output tables, a better ratio than the default level for little extra time
+PARQUET_COMPRESSION_LEVEL = 3
+
 
 def parse_alignment_bam(
     input_bam: Path,
@@ -27,8 +35,9 @@ def parse_alignment_bam(
     overlap_table: Path = None,
     alignment_summary: Path = None,
     read_summary: Path = None,
-    chunksize: int = 50000,
+    chunksize: int = None,
     n_workers: int = 1,
+    threads: int = 1,
 ):
     """Filter alignments to keep only alignments that contribute to contacts
 
@@ -38,28 +47,44 @@ def parse_alignment_bam(
     input_bam : str
                 Path to a namesorted bam with unfiltered alignments
     chunksize: int
-                The alignments are batched for processing, this controls the batch size
+                The alignments are batched for processing, this controls the batch size (in reads). If
+                not set the batch size is chosen based on the available memory.
+    threads: int
+                The number of htslib threads used to decompress the bam
 
     """
+    if chunksize is None:
+        # in parallel mode up to 2 * n_workers batches are queued for the workers plus the one being read
+        in_flight = 2 * n_workers + 1 if n_workers > 1 else 1
+        chunksize = memory_based_chunksize(READ_BYTES_ESTIMATE, in_flight=in_flight)
+        logger.info("Processing alignments in batches of {} reads".format(chunksize))
 
-    source_aligns = NameSortedBamSource(input_bam, metadata={})
+    source_aligns = NameSortedBamSource(input_bam, threads=threads, metadata={})
     source_aligns.discover()
 
     parallel = n_workers > 1
     fragment_df = fragment_df.set_index(["fragment_id"]).sort_index()  # .rename_axis("index", axis=0)
     if parallel:
-        from dask.distributed import Client, LocalCluster
-        from time import sleep
+        from collections import deque
+        from concurrent.futures import ProcessPoolExecutor
 
-        cluster = LocalCluster(processes=True, n_workers=n_workers, threads_per_worker=1)
-        client = Client(cluster)
-        fragment_df = client.scatter(fragment_df)
-
-    writers = dict(
-        alignment_table=TableWriter(alignment_table),
-        read_table=TableWriter(read_table),
-        overlap_table=TableWriter(overlap_table),
-    )
+        # the fragments are sent to each worker once when it starts rather than with every batch
+        executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_filter_worker, initargs=(fragment_df,))
+        pending = deque()
+    else:
+        # the overlap index for the fragments is built once and reused for every batch
+        fragment_index = fragment_df.ginterval.build_index()
+
+    # each batch of reads is written as a single row group so that downstream readers can split
+    # the tables on row groups without a read's alignments straddling two partitions. The tables
+    # are encoded and compressed in background threads while the next batch is read and filtered.
+    # Tables without an output path are still used for the summaries but aren't written.
+    table_paths = dict(alignment_table=alignment_table, read_table=read_table, overlap_table=overlap_table)
+    writers = {
+        key: ThreadedWriter(TableWriter(path, compression_level=PARQUET_COMPRESSION_LEVEL))
+        for key, path in table_paths.items()
+        if path is not None
+    }
 
     batch_progress_bar = tqdm(total=None, desc="Alignments submitted: ", unit=" alignments", position=0)
     alignment_progress = AlignmentProgress(position=1)
@@ -69,58 +94,92 @@ def parse_alignment_bam(
     # stream that holds the raw alignment dfs
     bam_stream = Stream()
 
-    # stream that holds the filtered/processed alignments
+    # stream that holds the filtered/processed alignments, in parallel mode the results
+    # come back from the worker processes and are emitted straight into this stream
     if parallel:
-        filtered_align_stream = (
-            bam_stream.scatter().map(filter_read_alignments, fragment_df=fragment_df).buffer(n_workers).gather()
-        )
+        filtered_align_stream = Stream()
     else:
-        filtered_align_stream = bam_stream.map(filter_read_alignments, fragment_df=fragment_df)
+        filtered_align_stream = bam_stream.map(filter_read_alignments, fragment_df=fragment_index)
 
     # write the alignments using the table writer, updating progress bar as we go
     align_sink = (  # noqa: F841
         filtered_align_stream.pluck("alignment_table")
         .accumulate(alignment_progress, returns_state=True, start=alignment_progress)
-        .sink(writers["alignment_table"])
+        .sink(writers.get("alignment_table", _discard))
     )
 
     read_sink = (  # noqa: F841
         filtered_align_stream.pluck("read_table")
         .accumulate(read_progress, returns_state=True, start=read_progress)
-        .sink(writers["read_table"])
+        .sink(writers.get("read_table", _discard))
     )
 
-    overlap_sink = filtered_align_stream.pluck("overlap_table").sink(writers["overlap_table"])  # noqa: F841
-
-    for batch_idx, align_df in enumerate(source_aligns.read_chunked(chunksize=chunksize)):
-        bam_stream.emit(align_df)
-        batch_progress_bar.update(len(align_df))
-        batch_progress_bar.set_postfix({"batches": batch_idx})
-
-    if parallel:
-        while True:
-            processing = client.processing()
-            still_running = [len(v) > 0 for k, v in processing.items()]
-            if any(still_running):
-                sleep(10)
+    if "overlap_table" in writers:
+        overlap_sink = filtered_align_stream.pluck("overlap_table").sink(writers["overlap_table"])  # noqa: F841
+
+    try:
+        for batch_idx, align_df in enumerate(source_aligns.read_chunked(chunksize=chunksize)):
+            if parallel:
+                pending.append(executor.submit(_filter_batch, align_df))
+                # bound the number of batches in flight so the reader can't run too far ahead of the
+                # workers, results are written in submission order
+                while len(pending) > 2 * n_workers:
+                    filtered_align_stream.emit(pending.popleft().result())
             else:
-                break
-        client.close()
-        cluster.close()
+                bam_stream.emit(align_df)
+            batch_progress_bar.update(len(align_df))
+            batch_progress_bar.set_postfix({"batches": batch_idx})
+
+        if parallel:
+            while pending:
+                filtered_align_stream.emit(pending.popleft().result())
+
+        # closing waits for the background writer threads to finish
+        for key in list(writers):
+            writers.pop(key).close()
+    except BaseException:
+        # don't leave workers running or partial tables behind
+        if parallel:
+            for future in pending:
+                future.cancel()
+        for writer in writers.values():
+            writer.abort()
+        raise
+    finally:
+        if parallel:
+            executor.shutdown()
 
     batch_progress_bar.close()
     alignment_progress.close()
-    alignment_progress.save(alignment_summary)
     read_progress.close()
-    read_progress.save(read_summary)
+    if alignment_summary is not None:
+        alignment_progress.save(alignment_summary)
+    if read_summary is not None:
+        read_progress.save(read_summary)
     sys.stderr.write("\n\n\n")
     sys.stdout.write("\n")
     return read_progress.final_stats()
 
 
+def _discard(df):
+    pass
+
+
+_worker_fragment_index = None
+
+
+def _init_filter_worker(fragment_df: FragmentDf):
+    global _worker_fragment_index
+    _worker_fragment_index = fragment_df.ginterval.build_index()
+
+
+def _filter_batch(df: BamEntryDf):
+    return filter_read_alignments(df, fragment_df=_worker_fragment_index)
+
+
 def filter_read_alignments(
     df: BamEntryDf,
-    fragment_df: FragmentDf,
+    fragment_df: Union[FragmentDf, GenomeIntervalIndex],
     mapping_quality_cutoff: int = 1,
     min_overlap_length: int = 10,
     containment_cutoff: float = 99.0,
@@ -130,8 +189,7 @@ def filter_read_alignments(
 
     # calculate fragment overlaps
     overlaps = (
-        res.ginterval.overlap(fragment_df)
-        .query("overlap_length >= {}".format(min_overlap_length))
+        res.ginterval.overlap(fragment_df, min_overlap_length=min_overlap_length)
         .loc[
             :,
             ["align_idx", "fragment_id", "other_start", "other_end", "overlap_length", "perc_of_self", "perc_of_other"],
@@ -179,18 +237,26 @@ def filter_read_alignments(
     res.loc[unmapped_mask, "reason"] = "unmapped"
 
     # if not unmapped, but mapping quality below cutoff then fail
-    fail_mq_mask = ~unmapped_mask & (df.mapping_quality <= mapping_quality_cutoff)
+    fail_mq_mask = ~unmapped_mask & (res.mapping_quality <= mapping_quality_cutoff)
     res.loc[fail_mq_mask, "pass_filter"] = False
     res.loc[fail_mq_mask, "reason"] = "low_mq"
 
     # no need to do other checks if nothing left
     if res["pass_filter"].any():
-        # for the remaining alignments filtering happens on a per-read basis
-        by_read_res = (
-            res.query("pass_filter == True")
-            .groupby("read_name", sort=False, as_index=False)
-            .apply(apply_per_read_filters)
+        # the remaining alignments are filtered within each read, the singleton and overlap filters
+        # are applied to every read at once so only reads with more than one alignment left need
+        # the per-read shortest path search
+        by_read_res = res[res.pass_filter].pipe(filter_singleton).pipe(filter_overlap_on_query)
+        multi_align_mask = by_read_res.pass_filter & (
+            by_read_res.groupby("read_name", sort=False)["pass_filter"].transform("sum") > 1
         )
+        if multi_align_mask.any():
+            shortest_path_res = (
+                by_read_res[multi_align_mask]
+                .groupby("read_name", sort=False, group_keys=False)
+                .apply(filter_shortest_path)
+            )
+            by_read_res.update(shortest_path_res[["pass_filter", "reason"]])
         res.update(by_read_res[["pass_filter", "reason"]])
         res = res.astype({"reason": FILTER_REASON_DTYPE})
     res = res.reset_index().porec_align.cast(subset=True, fillna=True)
@@ -226,26 +292,17 @@ def calculate_read_stats(align_df: PoreCAlignDf) -> PoreCReadDf:
         .rename(columns={"fragment_id": "unique_fragments_assigned", "pass_filter": "num_pass_aligns"})
     )
 
-    def count_contacts(chroms: pd.Series):
-        """Take a list of chromosomes and calculate the total number of contacts (N choose 2) and the
-        number of those that are cis
-        """
-        if len(chroms) < 2:
-            res = {"num_contacts": 0, "num_cis_contacts": 0}
-        else:
-            is_cis = np.array([chrom1 == chrom2 for (chrom1, chrom2) in combinations(chroms, 2)])
-            res = {"num_contacts": len(is_cis), "num_cis_contacts": is_cis.sum()}
-        res["num_chroms_contacted"] = chroms.nunique()
-        return pd.DataFrame(res, index=[chroms.name])
-
-    def _check_index(_df):
-        level_0 = _df.index.get_level_values(0)
-        level_1 = _df.index.get_level_values(1)
-        assert (level_0 == level_1).all()
-        return _df
-
-    contact_stats = (
-        pass_aligns.groupby(["read_idx"], sort=False)["chrom"].apply(count_contacts).pipe(_check_index).droplevel(1)
+    # every pair of pass alignments on a read is a contact, count them from the number of alignments
+    # per (read, chromosome) rather than comparing chromosome names pair by pair
+    chrom_counts = pass_aligns.groupby(["read_idx", "chrom"], sort=False, observed=True).size()
+    per_read = chrom_counts.groupby(level="read_idx", sort=False)
+    aligns_per_read = per_read.sum()
+    contact_stats = pd.DataFrame(
+        {
+            "num_contacts": aligns_per_read * (aligns_per_read - 1) // 2,
+            "num_cis_contacts": (chrom_counts * (chrom_counts - 1) // 2).groupby(level="read_idx", sort=False).sum(),
+            "num_chroms_contacted": per_read.size(),
+        }
     )
 
     # create a merged dataframe with one row per read
@@ -253,29 +310,28 @@ def calculate_read_stats(align_df: PoreCAlignDf) -> PoreCReadDf:
     return res.reset_index().porec_read.cast(subset=True, fillna=True)
 
 
-def apply_per_read_filters(read_df):
-    return read_df.pipe(filter_singleton).pipe(filter_overlap_on_query).pipe(filter_shortest_path)
-
-
-def filter_singleton(read_df):
-    if len(read_df) == 1:  # if you have a single alignment at this point you fail
-        read_df.loc[:, "pass_filter"] = False
-        read_df.loc[:, "reason"] = "singleton"
-    return read_df
+def filter_singleton(align_df):
+    # if a read has a single alignment at this point it fails
+    singleton_mask = align_df.groupby("read_name", sort=False)["read_name"].transform("size") == 1
+    align_df.loc[singleton_mask, "pass_filter"] = False
+    align_df.loc[singleton_mask, "reason"] = "singleton"
+    return align_df
 
 
-def filter_overlap_on_query(read_df):
-    overlap_on_read = read_df.duplicated(subset=["read_start", "read_end"], keep=False)
+def filter_overlap_on_query(align_df):
+    # alignments with the same endpoints on a read are alternatives, only keep the highest scoring
+    read_interval = ["read_name", "read_start", "read_end"]
+    overlap_on_read = align_df.duplicated(subset=read_interval, keep=False)
     if overlap_on_read.any():
-        best_align_idx = read_df.loc[overlap_on_read, :].groupby(["read_start", "read_end"])["score"].idxmax()
+        best_align_idx = align_df.loc[overlap_on_read, :].groupby(read_interval, sort=False)["score"].idxmax()
         overlap_on_read[best_align_idx.values] = False
-        read_df.loc[overlap_on_read, "pass_filter"] = False
-        read_df.loc[overlap_on_read, "reason"] = "overlap_on_read"
-    return read_df
+        align_df.loc[overlap_on_read, "pass_filter"] = False
+        align_df.loc[overlap_on_read, "reason"] = "overlap_on_read"
+    return align_df
 
 
 def minimap_gapscore(length, o1=4, o2=24, e1=2, e2=1):
-    return min([o1 + int(length) * e1, o2 + int(length) * e2])
+    return np.minimum(o1 + length * e1, o2 + length * e2)
 
 
 def bwa_gapscore(length, O=5, E=2):  # noqa: E741
@@ -285,31 +341,29 @@ def bwa_gapscore(length, O=5, E=2):  # noqa: E741
 
 
 def create_align_graph(aligns, gap_fn):
+    import networkx as nx
+
     # we'll visit the alignments in order of increasing endpoint on the read, need to keep
     # the ids as the index in the original list of aligns for filtering later
-    aligns = aligns[["read_start", "read_end", "read_length", "score"]].copy().sort_values(["read_end"])
-    node_ids = list(aligns.index)
+    aligns = aligns[["read_start", "read_end", "read_length", "score"]].sort_values(["read_end"])
+    node_ids = aligns.index.values
+    # signed so that the gap and score arithmetic can go negative
+    read_start, read_end, read_length, score = (
+        aligns[col].values.astype(np.int64) for col in ["read_start", "read_end", "read_length", "score"]
+    )
     graph = nx.DiGraph()
     # initialise graph with root and sink node, and one for each alignment
     # edges in the graph will represent transitions from one alignment segment
     # to the next
-    graph.add_nodes_from(["ROOT", "SINK"] + node_ids)
-    for align in aligns.itertuples():
-        align_idx = align.Index
-        align_score = align.score
-        gap_penalty_start = gap_fn(align.read_start)
-        graph.add_edge("ROOT", align_idx, weight=gap_penalty_start - align_score)
-        gap_penalty_end = gap_fn(int(align.read_length - align.read_end))
-        graph.add_edge(align_idx, "SINK", weight=gap_penalty_end)
-
-    # for each pair of aligned segments add an edge
-    for idx_a, align_idx_a in enumerate(node_ids[:-1]):
-        align_a_end = aligns.at[align_idx_a, "read_end"]
-        for align_idx_b in node_ids[idx_a + 1 :]:  # noqa: E203 black does this
-            align_b_score = aligns.at[align_idx_b, "score"]
-            align_b_read_start = aligns.at[align_idx_b, "read_start"]
-            gap_penalty = gap_fn(abs(int(align_b_read_start) - int(align_a_end)))
-            graph.add_edge(align_idx_a, align_idx_b, weight=gap_penalty - align_b_score)
+    graph.add_nodes_from(["ROOT", "SINK"] + node_ids.tolist())
+    graph.add_weighted_edges_from(zip(repeat("ROOT"), node_ids.tolist(), (gap_fn(read_start) - score).tolist()))
+    graph.add_weighted_edges_from(zip(node_ids.tolist(), repeat("SINK"), gap_fn(read_length - read_end).tolist()))
+
+    # for each pair of aligned segments add an edge, the gap penalties for every pair are calculated
+    # at once from the upper triangle of the all-vs-all matrix
+    idx_a, idx_b = np.triu_indices(len(node_ids), 1)
+    weights = gap_fn(np.abs(read_start[idx_b] - read_end[idx_a])) - score[idx_b]
+    graph.add_weighted_edges_from(zip(node_ids[idx_a].tolist(), node_ids[idx_b].tolist(), weights.tolist()))
 
     return graph
 
@@ -327,6 +381,8 @@ def filter_shortest_path(read_df, aligner="minimap2"):
         gap_fn = bwa_gapscore
     else:
         raise ValueError(f"Unrecognised aligner: {aligner}")
+    import networkx as nx
+
     graph = create_align_graph(aligns, gap_fn)
     distance, shortest_path = nx.single_source_bellman_ford(graph, "ROOT", "SINK")
     for idx in aligns.index:
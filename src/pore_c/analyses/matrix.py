@@ -1,8 +1,9 @@
 from logging import getLogger
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from cooler import Cooler, annotate
+from cooler import Cooler
 
 logger = getLogger(__name__)
 
@@ -14,7 +15,10 @@ def correlate(x_cool: Cooler, y_cool: Cooler, xy_path: Path, coefficients_path:
         i = cool.info
         metadata[key] = {"contacts": int(i["sum"]), "non_zero_pixels": int(i["nnz"]), "num_bins": int(i["nbins"])}
 
-    chrom_dtype = pd.CategoricalDtype(list(set(x_cool.chromnames).union(set(x_cool.chromnames))))
+    # keep the chromosomes in file order so the output doesn't depend on set ordering
+    x_chrom_names = x_cool.chromnames
+    y_only = set(y_cool.chromnames).difference(x_chrom_names)
+    chrom_dtype = pd.CategoricalDtype(x_chrom_names + [c for c in y_cool.chromnames if c in y_only])
     xy_df = join_count(x_cool, y_cool).astype({"chrom1": chrom_dtype, "chrom2": chrom_dtype})
     logger.debug("Found {} non-zero overlapping bins".format(len(xy_df)))
     xy_df.to_parquet(xy_path)
@@ -37,7 +41,12 @@ def correlate(x_cool: Cooler, y_cool: Cooler, xy_path: Path, coefficients_path:
         num_bins = len(_df)
         for method in ["pearson", "spearman"]:
             logger.debug(f"Calculating {method} correlation coefficent for {label} contacts in {num_bins} bins")
-            corr = _df[["x", "y"]].corr(method).loc["x", "y"]
+            if method == "spearman":
+                # the spearman coefficient is the pearson coefficient of the ranks
+                ranks = pd.DataFrame({"x": rank_counts(_df["x"].values), "y": rank_counts(_df["y"].values)})
+                corr = ranks.corr("pearson").loc["x", "y"]
+            else:
+                corr = _df[["x", "y"]].corr(method).loc["x", "y"]
             logger.info(f"{method} correlation coefficent for {label} contacts: {corr}")
             res.append({"subset": label, "corr_method": method, "coefficient": corr})
     coeff_df = (
@@ -49,29 +58,49 @@ def correlate(x_cool: Cooler, y_cool: Cooler, xy_path: Path, coefficients_path:
     return metadata
 
 
-def get_count_df(cool_mat):
-    logger.debug(f"Creating counts dataframe for {cool_mat}")
-    df = (
-        annotate(cool_mat.pixels()[:], cool_mat.bins()[:]["chrom"])
-        .eval("is_cis = (chrom1 == chrom2)")
-        .pipe(get_distance, cool_mat.binsize)
-        .set_index(["bin1_id", "bin2_id"])
-        .sort_index()
-    )
-    num_bins = len(df)
-    logger.info(f"Read {num_bins} bins from {cool_mat}")
+def rank_counts(counts: np.ndarray) -> np.ndarray:
+    """The average rank of each value in an array, ties get the mean of the ranks they span
+
+    Contact counts are small non-negative integers so the ranks can be found by counting rather
+    than sorting, anything else falls back to a sort-based rank.
+    """
+    if len(counts) == 0 or not np.issubdtype(counts.dtype, np.integer) or counts.min() < 0:
+        return pd.Series(counts).rank().values
+    num_with_value = np.bincount(counts)
+    average_rank = np.cumsum(num_with_value) - (num_with_value - 1) * 0.5
+    return average_rank[counts]
+
+
+def get_pixel_df(cool_mat):
+    logger.debug(f"Reading pixels from {cool_mat}")
+    df = cool_mat.pixels()[:]
+    logger.info(f"Read {len(df)} pixels from {cool_mat}")
     return df
 
 
 def join_count(x_cool, y_cool):
-    x_df = get_count_df(x_cool).rename(columns={"count": "x"})
-    y_df = get_count_df(y_cool).rename(columns={"count": "y"})[["y"]]
-    res = x_df.join(y_df, how="inner")
-    return res
+    x_df, y_df = get_pixel_df(x_cool), get_pixel_df(y_cool)
+    # hash join on the non-zero pixels, only the pixels present in both matrices get annotated
+    res = pd.merge(
+        x_df.rename(columns={"count": "x"}),
+        y_df.rename(columns={"count": "y"}),
+        on=["bin1_id", "bin2_id"],
+        how="inner",
+        sort=False,
+    )
+    chroms = x_cool.bins()["chrom"][:]
+    bin1_chrom = chroms.values.take(res["bin1_id"].values)
+    bin2_chrom = chroms.values.take(res["bin2_id"].values)
+    res = (
+        res.assign(chrom1=bin1_chrom, chrom2=bin2_chrom, is_cis=bin1_chrom.codes == bin2_chrom.codes)
+        .pipe(get_distance, x_cool.binsize)
+        .set_index(["bin1_id", "bin2_id"])
+        .sort_index()
+    )
+    return res[["chrom1", "chrom2", "x", "is_cis", "distance", "y"]]
 
 
 def get_distance(df, resolution):
-    distance = df.eval(f"abs(bin1_id - bin2_id) * {resolution}")
-    distance[~df.is_cis] = -1
-    df["distance"] = distance
+    distance = np.abs(df["bin1_id"].values.astype(np.int64) - df["bin2_id"].values.astype(np.int64)) * resolution
+    df["distance"] = np.where(df["is_cis"].values, distance, -1)
     return df
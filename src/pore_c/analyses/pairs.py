@@ -1,22 +1,23 @@
+import json
 import sys
-from itertools import combinations
 from logging import getLogger
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Union
 
 import numpy as np
 import pandas as pd
 from streamz import Stream
 from tqdm import tqdm
 
-from pore_c.datasources import IndexedPairFile
+from pore_c.datasources import IndexedPairFile, ParquetPairFile
 from pore_c.io import PairFileWriter
-from pore_c.model import (FRAG_IDX_DTYPE, AlignDf, Chrom, GenomeIntervalDf,
-                          HicTxtDf, PairDf, SalsaDf)
+from pore_c.model import CONTACT_COUNT_DTYPE, FRAG_IDX_DTYPE, AlignDf, Chrom, HicTxtDf, PairDf, SalsaDf
 from pore_c.utils import DataFrameProgress
 
 logger = getLogger(__name__)
 
+PARQUET_ROW_GROUP_SIZE = 64000
+
 
 class PairsProgress(DataFrameProgress):
     def __init__(self, **kwds):
@@ -44,21 +45,43 @@ class MatrixAccumlator(DataFrameProgress):
         kwds["desc"] = "Batches processed"
         kwds["unit"] = " batches"
         super(MatrixAccumlator, self).__init__(**kwds)
+        # the pixels are held as a sorted array of (bin1_id, bin2_id) packed into a single uint64
+        # so that each batch is merged in with a binary search rather than an index alignment
+        self._keys = None
+        self._counts = None
+
+    @staticmethod
+    def _pack_bins(bin1_id, bin2_id):
+        return (bin1_id.astype(np.uint64) << np.uint64(32)) | bin2_id.astype(np.uint64)
+
+    def _unpack_bins(self):
+        return (self._keys >> np.uint64(32)).astype(FRAG_IDX_DTYPE), self._keys.astype(FRAG_IDX_DTYPE)
 
     def update_data(self, df):
-        _df = df.set_index(["bin1_id", "bin2_id"]).sort_index()
-        if self._data is None:
-            self._data = _df
-        else:
-            self._data = self._data.add(_df, fill_value=0).astype(int)
+        keys, inverse = np.unique(self._pack_bins(df["bin1_id"].values, df["bin2_id"].values), return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=df["count"].values, minlength=len(keys)).astype(
+            CONTACT_COUNT_DTYPE
+        )
+        if self._keys is None:
+            self._keys, self._counts = keys, counts
+            return
+        idx = np.searchsorted(self._keys, keys)
+        found = idx < len(self._keys)
+        found[found] = self._keys[idx[found]] == keys[found]
+        self._counts[idx[found]] += counts[found]
+        self._keys = np.insert(self._keys, idx[~found], keys[~found])
+        self._counts = np.insert(self._counts, idx[~found], counts[~found])
 
     def get_summary(self):
+        # called after every batch to update the progress bar so work on the raw arrays
+        counts = self._counts
+        bin1_id, bin2_id = self._unpack_bins()
         summary = {
-            "num_pixels": len(self._data),
-            "max_count": int(self._data["count"].max()),
-            "median_count": int(self._data["count"].median()),
-            "total_contacts": int(self._data["count"].sum()),
-            "diagonal_contacts": int(self._data.query("bin1_id == bin2_id")["count"].sum()),
+            "num_pixels": len(counts),
+            "max_count": int(counts.max()),
+            "median_count": int(np.median(counts)),
+            "total_contacts": int(counts.sum(dtype=np.uint64)),
+            "diagonal_contacts": int(counts[bin1_id == bin2_id].sum(dtype=np.uint64)),
         }
         return summary
 
@@ -67,63 +90,102 @@ class MatrixAccumlator(DataFrameProgress):
         self._bar.set_postfix(self.get_summary())
 
     def save_coo(self, path):
-        if self._data is None:
+        if self._keys is None:
             raise ValueError(f"No data to write to {path}")
-        self._data.to_csv(path, sep="\t", header=None)
+        bin1_id, bin2_id = self._unpack_bins()
+        pd.DataFrame({"bin1_id": bin1_id, "bin2_id": bin2_id, "count": self._counts}).to_csv(
+            path, sep="\t", header=None, index=False
+        )
 
     def save_bedgraph(self, path, bin_df):
         raise NotImplementedError
 
 
-def assign_to_bins(pair_df, bin_df, sort_bins=True):
-    _dfs = []
+def chrom_bin_offsets(chrom_lengths: Dict[Chrom, int], resolution: int) -> pd.DataFrame:
+    """The number of fixed-width bins on each chromosome and the id of the first one, the bin ids
+    match those from `GenomeIntervalDf.fixed_width_bins`"""
+    lengths = np.array(list(chrom_lengths.values()), dtype=np.int64)
+    num_bins = (lengths + resolution - 1) // resolution
+    return pd.DataFrame(
+        {"length": lengths, "offset": np.cumsum(num_bins) - num_bins}, index=pd.Index(list(chrom_lengths.keys()))
+    )
+
+
+def _chrom_ids(chroms: pd.Series, chrom_index: pd.Index) -> np.ndarray:
+    # pairs read from parquet have categorical chromosomes, only look up each category once
+    if isinstance(chroms.dtype, pd.CategoricalDtype):
+        lookup = np.append(chrom_index.get_indexer(chroms.cat.categories), -1)
+        return lookup[chroms.cat.codes.values]
+    return chrom_index.get_indexer(chroms)
+
+
+def assign_to_bins(pair_df, chrom_offsets, resolution, sort_bins=True):
+    # the bins are fixed width so the bin id is the first bin on the chromosome plus pos // resolution
+    overlaps = {}
     for pos in ["1", "2"]:
-        _df = (
-            pair_df.loc[:, [f"chr{pos}", f"pos{pos}"]]
-            .rename(columns={f"chr{pos}": "chrom", f"pos{pos}": "start"})
-            .assign(end=lambda x: x.start + 1)
-            # .assign(start = lambda x: x.start - 1)
+        positions = pair_df[f"pos{pos}"].values.astype(np.int64)
+        chrom_ids = _chrom_ids(pair_df[f"chr{pos}"], chrom_offsets.index)
+        lengths = chrom_offsets["length"].values[chrom_ids]
+        offsets = chrom_offsets["offset"].values[chrom_ids]
+        bin_ids = np.where(
+            (chrom_ids >= 0) & (positions >= 0) & (positions < lengths), offsets + positions // resolution, -1
         )
-        bins = _df.ginterval.assign(bin_df).rename(columns={"other": f"bin{pos}_id"})
-        _dfs.append(bins)
-    overlaps = pd.concat(_dfs, axis=1)  # .astype(FRAG_IDX_DTYPE)
-    has_nulls = overlaps.isna().any(axis=1)
+        overlaps[f"bin{pos}_id"] = bin_ids
+    overlaps = pd.DataFrame(overlaps, index=pair_df.index)
+    has_nulls = (overlaps < 0).any(axis=1)
     if has_nulls.any():
         raise ValueError("Some fragments missing overlaps: {}".format(pair_df[has_nulls]))
     overlaps = overlaps.astype(FRAG_IDX_DTYPE)
     if sort_bins:
         # pairs files are in lexographic order, matrxi is in fasta order
-        switch_bins = overlaps["bin1_id"] > overlaps["bin2_id"]
-        if switch_bins.any():
+        bin1_ids, bin2_ids = overlaps["bin1_id"].values, overlaps["bin2_id"].values
+        if (bin1_ids > bin2_ids).any():
             logger.warning("Reordering bins")
+            # elementwise min/max of the two columns, avoids the row-wise reductions over the frame
             overlaps = pd.DataFrame(
-                {"bin1_id": overlaps.min(axis=1), "bin2_id": overlaps.max(axis=1)},
+                {"bin1_id": np.minimum(bin1_ids, bin2_ids), "bin2_id": np.maximum(bin1_ids, bin2_ids)},
                 index=overlaps.index,
-                dtype=FRAG_IDX_DTYPE,
             )
-            switch_bins = overlaps["bin1_id"] > overlaps["bin2_id"]
-            assert not switch_bins.any()
     return overlaps
 
 
-def overlap_count(pair_df, bin_df=None):
-    df = (
-        assign_to_bins(pair_df, bin_df)
-        .groupby(["bin1_id", "bin2_id"])
-        .size()
-        .rename("count")
-        .to_frame()
-        .reset_index()
-        .astype({"bin1_id": int, "bin2_id": int})
+def overlap_count(pair_df, chrom_offsets=None, resolution=None):
+    overlaps = assign_to_bins(pair_df, chrom_offsets, resolution)
+    # count the packed (bin1_id, bin2_id) keys rather than grouping on both columns
+    keys, counts = np.unique(
+        MatrixAccumlator._pack_bins(overlaps["bin1_id"].values, overlaps["bin2_id"].values), return_counts=True
+    )
+    df = pd.DataFrame(
+        {
+            "bin1_id": (keys >> np.uint64(32)).astype(FRAG_IDX_DTYPE),
+            "bin2_id": keys.astype(FRAG_IDX_DTYPE),
+            "count": counts.astype(CONTACT_COUNT_DTYPE),
+        }
     )
     return df
 
 
-def convert_pairs_to_matrix(pairs_datasource: IndexedPairFile, resolution: int, coo: Path = None, n_workers: int = 1):
+def count_partition(
+    partition: int,
+    pairs_datasource: Union[IndexedPairFile, ParquetPairFile] = None,
+    chrom_offsets: pd.DataFrame = None,
+    resolution: int = None,
+):
+    """Read a partition of the pairs file and count the pairs falling in each pair of bins"""
+    pair_df = pairs_datasource._get_partition(partition, usecols=["chr1", "pos1", "chr2", "pos2"])
+    if pair_df.empty:
+        logger.debug(f"Empty partition {partition}")
+        return None
+    return overlap_count(pair_df, chrom_offsets=chrom_offsets, resolution=resolution)
+
+
+def convert_pairs_to_matrix(
+    pairs_datasource: Union[IndexedPairFile, ParquetPairFile], resolution: int, coo: Path = None, n_workers: int = 1
+):
     ds = pairs_datasource
     ds.discover()
     chrom_lengths = ds._chroms
-    bin_df = GenomeIntervalDf.fixed_width_bins(chrom_lengths, resolution).set_index("bin_id")
+    chrom_offsets = chrom_bin_offsets(chrom_lengths, resolution)
     parallel = n_workers > 1
     if parallel:
         from time import sleep
@@ -131,27 +193,32 @@ def convert_pairs_to_matrix(pairs_datasource: IndexedPairFile, resolution: int,
 
         cluster = LocalCluster(processes=True, n_workers=n_workers, threads_per_worker=1)
         client = Client(cluster)
-        bin_df = client.scatter(bin_df)
 
     batch_progress_bar = tqdm(total=ds.npartitions, desc="Batches submitted: ", unit=" batches", position=0)
     matrix = MatrixAccumlator(position=1)
-    # stream that holds the filtered/processed alignments
-    df_stream = Stream()
+    # stream of partition indices, the partitions are read by whichever process counts them so
+    # that the pairs file isn't parsed in this process and then shipped out to the workers
+    partition_stream = Stream()
     if parallel:
-        coo_stream = df_stream.scatter().buffer(n_workers).map(overlap_count, bin_df=bin_df).gather()
+        coo_stream = (
+            partition_stream.scatter()
+            .map(count_partition, pairs_datasource=ds, chrom_offsets=chrom_offsets, resolution=resolution)
+            .buffer(n_workers)
+            .gather()
+        )
     else:
-        coo_stream = df_stream.map(overlap_count, bin_df=bin_df)
-
-    write_sink = coo_stream.accumulate(matrix, returns_state=True, start=matrix).sink(lambda x: x)  # noqa: F841
+        coo_stream = partition_stream.map(
+            count_partition, pairs_datasource=ds, chrom_offsets=chrom_offsets, resolution=resolution
+        )
 
-    partition_range = range(ds.npartitions)
+    write_sink = (  # noqa: F841
+        coo_stream.filter(lambda x: x is not None)
+        .accumulate(matrix, returns_state=True, start=matrix)
+        .sink(lambda x: x)
+    )
 
-    for partition in partition_range:
-        _df = ds._get_partition(partition, usecols=["chr1", "pos1", "chr2", "pos2"])
-        if not _df.empty:
-            df_stream.emit(_df)
-        else:
-            logger.debug(f"Empty partition {partition}")
+    for partition in range(ds.npartitions):
+        partition_stream.emit(partition)
         batch_progress_bar.update(1)
 
     if parallel:
@@ -177,8 +244,15 @@ def convert_pairs_to_matrix(pairs_datasource: IndexedPairFile, resolution: int,
 
 
 def convert_align_df_to_pairs(
-    align_df: AlignDf, chrom_lengths: Dict[Chrom, int], genome_assembly: str, pair_file: str, n_workers: int = 1
+    align_df: AlignDf,
+    chrom_lengths: Dict[Chrom, int],
+    genome_assembly: str,
+    pair_file: str,
+    n_workers: int = 1,
+    pair_parquet: Path = None,
 ):
+    """Convert an alignment table to pairs format, if `pair_parquet` is set the pairs are
+    also written as a parquet table that can be binned without reparsing the text"""
     parallel = n_workers > 1
     if parallel:
         from time import sleep
@@ -187,7 +261,9 @@ def convert_align_df_to_pairs(
         cluster = LocalCluster(processes=True, n_workers=n_workers, threads_per_worker=1)
         client = Client(cluster)
 
-    writer = PairFileWriter(pair_file, chrom_lengths, genome_assembly, columns=list(PairDf.DTYPE.keys()))
+    writer = PairFileWriter(
+        pair_file, chrom_lengths, genome_assembly, columns=list(PairDf.DTYPE.keys()), threads=n_workers
+    )
 
     batch_progress_bar = tqdm(total=align_df.npartitions, desc="Batches submitted: ", unit=" batches", position=0)
     pairs_progress = PairsProgress()
@@ -202,6 +278,13 @@ def convert_align_df_to_pairs(
     write_sink = pair_stream.accumulate(pairs_progress, returns_state=True, start=pairs_progress).sink(  # noqa: F841
         writer
     )
+    if pair_parquet:
+        from pore_c.io import TableWriter
+
+        parquet_writer = TableWriter(
+            pair_parquet, row_group_size=PARQUET_ROW_GROUP_SIZE, metadata={"chromsizes": json.dumps(chrom_lengths)}
+        )
+        parquet_sink = pair_stream.sink(parquet_writer)  # noqa: F841
 
     use_cols = [
         "pass_filter",
@@ -219,12 +302,7 @@ def convert_align_df_to_pairs(
     ]
     for partition in range(align_df.npartitions):
         _df = align_df.partitions[partition].loc[:, use_cols]
-        if False:
-            df_stream.emit(_df.head(1000))
-            if partition > 2:
-                break
-        else:
-            df_stream.emit(_df.compute())
+        df_stream.emit(_df.compute())
         batch_progress_bar.update(1)
 
     if parallel:
@@ -239,6 +317,11 @@ def convert_align_df_to_pairs(
         client.close()
         cluster.close()
 
+    # the parquet table is closed first so that a failure sorting and indexing the pairs text doesn't
+    # leave its temporary file behind
+    if pair_parquet and parquet_writer.close() == 0 and pair_parquet.exists():
+        # no table is created when there are no pairs, don't leave one from an earlier run behind
+        pair_parquet.unlink()
     writer.close()
     pairs_progress.close()
     batch_progress_bar.close()
@@ -246,62 +329,77 @@ def convert_align_df_to_pairs(
     return {"contact_types": pairs_progress.get_summary()}
 
 
+def segment_pair_indices(read_idx: np.ndarray):
+    """Enumerate every pair of segments belonging to the same read.
+
+    `read_idx` must be grouped by read. Returns two arrays of positional indices (i, j) with i < j,
+    in the same order as itertools.combinations applied to each read in turn.
+    """
+    num_segments = len(read_idx)
+    if num_segments == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    read_starts = np.flatnonzero(np.r_[True, read_idx[1:] != read_idx[:-1]])
+    read_lengths = np.diff(np.r_[read_starts, num_segments])
+    read_ends = np.repeat(read_starts + read_lengths, read_lengths)
+    # each segment pairs with every later segment on the same read
+    pairs_per_segment = read_ends - np.arange(num_segments) - 1
+    idx1 = np.repeat(np.arange(num_segments), pairs_per_segment)
+    first_pair = np.cumsum(pairs_per_segment) - pairs_per_segment
+    idx2 = idx1 + 1 + np.arange(len(idx1)) - np.repeat(first_pair, pairs_per_segment)
+    return idx1, idx2
+
+
 def to_pairs(df: AlignDf) -> PairDf:
-    res = []
     keep_segments = (
         df.query("pass_filter == True").replace({"strand": {True: "+", False: "-"}})
         # convert strand to +/- and chrom to string for lexographical sorting to get upper-triangle
         .astype({"strand": PairDf.DTYPE["strand1"], "chrom": str})
+        .sort_values(["read_idx", "read_start"], kind="mergesort")
     )
-    for x, (read_idx, read_df) in enumerate(keep_segments.groupby("read_idx", as_index=False)):
-        if len(read_df) <= 1:
-            continue
-        read_id = "{}:{}".format(read_df.read_name.values[0], read_idx)
-        rows = list(
-            read_df.sort_values(["read_start"], ascending=True)
-            .assign(
-                pos_on_read=lambda x: np.arange(len(x)),
-                fragment_midpoint=lambda x: np.rint((x.fragment_start + x.fragment_end) * 0.5).astype(int),
-            )
-            .itertuples()
-        )
-        for (pos1, pos2) in combinations(rows, 2):
-            if pos1.align_idx == pos2.align_idx:
-                raise ValueError
-            res.append(position_pair_to_tuple(pos1, pos2, read_id))
-    return pd.DataFrame(res, columns=PairDf.DTYPE.keys()).astype(PairDf.DTYPE)
-
-
-def position_pair_to_tuple(pos1, pos2, read_id):
-    switch_order = False  # reorder to make uppper triangle
-    distance_on_read = pos2.read_start - pos1.read_end
-    direct_neighbors = (pos2.pos_on_read - pos1.pos_on_read) == 1
-    if pos1.chrom == pos2.chrom:
-        if pos1.fragment_midpoint > pos2.fragment_midpoint:
-            switch_order = True
-    elif pos1.chrom > pos2.chrom:
-        switch_order = True
-    if switch_order:
-        pos1, pos2 = pos2, pos1
-    return (
-        read_id,
-        pos1.chrom,
-        pos1.fragment_midpoint,
-        pos2.chrom,
-        pos2.fragment_midpoint,
-        pos1.strand,
-        pos2.strand,
-        "DJ" if direct_neighbors else "IJ",
-        pos1.fragment_id,
-        pos2.fragment_id,
-        pos1.align_idx,
-        pos2.align_idx,
-        distance_on_read,
+    idx1, idx2 = segment_pair_indices(keep_segments["read_idx"].values)
+    align_idx = keep_segments["align_idx"].values
+    if (align_idx[idx1] == align_idx[idx2]).any():
+        raise ValueError
+    chrom = keep_segments["chrom"].to_numpy()
+    fragment_midpoint = np.rint(
+        (keep_segments["fragment_start"].values.astype(np.int64) + keep_segments["fragment_end"].values) * 0.5
+    ).astype(int)
+    # idx1 is always before idx2 on the read, reorder to make upper triangle
+    switch_order = np.where(
+        chrom[idx1] == chrom[idx2], fragment_midpoint[idx1] > fragment_midpoint[idx2], chrom[idx1] > chrom[idx2]
+    )
+    first = np.where(switch_order, idx2, idx1)
+    second = np.where(switch_order, idx1, idx2)
+    read_id = (keep_segments["read_name"].astype(str) + ":" + keep_segments["read_idx"].astype(str)).to_numpy()
+    strand = keep_segments["strand"].to_numpy()
+    fragment_id = keep_segments["fragment_id"].values
+    res = pd.DataFrame(
+        {
+            "readID": read_id[idx1],
+            "chr1": chrom[first],
+            "pos1": fragment_midpoint[first],
+            "chr2": chrom[second],
+            "pos2": fragment_midpoint[second],
+            "strand1": strand[first],
+            "strand2": strand[second],
+            "pair_type": np.where(idx2 - idx1 == 1, "DJ", "IJ"),
+            "frag1": fragment_id[first],
+            "frag2": fragment_id[second],
+            "align_idx1": align_idx[first],
+            "align_idx2": align_idx[second],
+            "distance_on_read": (
+                keep_segments["read_start"].values[idx2].astype(np.int64) - keep_segments["read_end"].values[idx1]
+            ),
+        },
+        columns=PairDf.DTYPE.keys(),
     )
+    return res.astype(PairDf.DTYPE)
 
 
 def convert_align_df_to_salsa(align_df: AlignDf, salsa_bed: Path, n_workers: int = 1):
-    from pore_c.io import SalsaBedFileWriter
+    """Convert an alignment table to salsa bed format, if `salsa_bed` has a .parquet suffix
+    the records are written as a parquet table instead"""
+    from pore_c.io import SalsaBedFileWriter, TableWriter
 
     parallel = n_workers > 1
     if parallel:
@@ -311,7 +409,10 @@ def convert_align_df_to_salsa(align_df: AlignDf, salsa_bed: Path, n_workers: int
         cluster = LocalCluster(processes=True, n_workers=n_workers, threads_per_worker=1)
         client = Client(cluster)
 
-    writer = SalsaBedFileWriter(salsa_bed)
+    if salsa_bed.suffix == ".parquet":
+        writer = TableWriter(salsa_bed, row_group_size=PARQUET_ROW_GROUP_SIZE)
+    else:
+        writer = SalsaBedFileWriter(salsa_bed)
 
     batch_progress_bar = tqdm(total=align_df.npartitions, desc="Batches submitted: ", unit=" batches", position=0)
 
@@ -359,29 +460,51 @@ def convert_align_df_to_salsa(align_df: AlignDf, salsa_bed: Path, n_workers: int
 
 
 def to_salsa(df: AlignDf) -> SalsaDf:
-    res = []
-
     keep_segments = (
         df.query("pass_filter == True")
         .replace({"strand": {True: "+", False: "-"}})
         .astype({"strand": SalsaDf.DTYPE["strand"], "chrom": str})
+        .sort_values(["read_idx", "read_start"], kind="mergesort")
+    )
+    idx1, idx2 = segment_pair_indices(keep_segments["read_idx"].values)
+    if (keep_segments["align_idx"].values[idx1] == keep_segments["align_idx"].values[idx2]).any():
+        raise ValueError
+    # each pair is written as two records, the first and second segment of a paired-end read
+    rows = np.empty(2 * len(idx1), dtype=np.int64)
+    rows[0::2], rows[1::2] = idx1, idx2
+    read_pair_id = (
+        keep_segments["read_name"].astype(str).iloc[rows].reset_index(drop=True)
+        + "_"
+        + pd.Series(np.repeat(_pair_number_on_read(keep_segments["read_idx"].values[idx1]), 2)).astype(str)
+        + np.tile(["/1", "/2"], len(idx1))
+    )
+    res = pd.DataFrame(
+        {
+            "chr": keep_segments["chrom"].to_numpy()[rows],
+            "start": keep_segments["start"].values[rows],
+            "end": keep_segments["end"].values[rows],
+            "read_pair_id": read_pair_id.to_numpy(),
+            "mapping_quality": keep_segments["mapping_quality"].values[rows],
+            "strand": keep_segments["strand"].to_numpy()[rows],
+        },
+        columns=SalsaDf.DTYPE.keys(),
     )
-    for x, (read_idx, read_df) in enumerate(keep_segments.groupby("read_idx", as_index=False)):
-        if len(read_df) <= 1:
-            continue
-        rows = list(read_df.sort_values(["read_start"], ascending=True).itertuples())
+    return res.astype(SalsaDf.DTYPE)
 
-        for combi, (pos1, pos2) in enumerate(combinations(rows, 2)):
-            if pos1.align_idx == pos2.align_idx:
-                raise ValueError
-            for rec, paired_id in zip([pos1, pos2], [1, 2]):
-                paired_read_id = f"{rec.read_name}_{combi}/{paired_id}"
-                res.append((rec.chrom, rec.start, rec.end, paired_read_id, rec.mapping_quality, rec.strand))
-    return pd.DataFrame(res, columns=SalsaDf.DTYPE.keys()).astype(SalsaDf.DTYPE)
+
+def _pair_number_on_read(pair_read_idx: np.ndarray) -> np.ndarray:
+    """Number the pairs of segments within each read, the pairs of a read must be contiguous"""
+    if len(pair_read_idx) == 0:
+        return np.zeros(0, dtype=np.int64)
+    read_starts = np.flatnonzero(np.r_[True, pair_read_idx[1:] != pair_read_idx[:-1]])
+    pairs_per_read = np.diff(np.r_[read_starts, len(pair_read_idx)])
+    return np.arange(len(pair_read_idx)) - np.repeat(read_starts, pairs_per_read)
 
 
 def convert_align_df_to_hic(align_df: AlignDf, hic_bed: Path, n_workers: int = 1, max_fragment_id: int = 0):
-    from pore_c.io import HicTxtFileWriter
+    """Convert an alignment table to hic text format, if `hic_bed` has a .parquet suffix
+    the (unsorted) records are written as a parquet table instead"""
+    from pore_c.io import HicTxtFileWriter, TableWriter
 
     parallel = n_workers > 1
     if parallel:
@@ -391,7 +514,10 @@ def convert_align_df_to_hic(align_df: AlignDf, hic_bed: Path, n_workers: int = 1
         cluster = LocalCluster(processes=True, n_workers=n_workers, threads_per_worker=1)
         client = Client(cluster)
 
-    writer = HicTxtFileWriter(hic_bed)
+    if hic_bed.suffix == ".parquet":
+        writer = TableWriter(hic_bed, row_group_size=PARQUET_ROW_GROUP_SIZE)
+    else:
+        writer = HicTxtFileWriter(hic_bed)
 
     batch_progress_bar = tqdm(total=align_df.npartitions, desc="Batches submitted: ", unit=" batch", position=0)
 
@@ -419,8 +545,6 @@ def convert_align_df_to_hic(align_df: AlignDf, hic_bed: Path, n_workers: int = 1
         _df = align_df.partitions[partition].loc[:, use_cols]
         df_stream.emit(_df.compute())
         batch_progress_bar.update(1)
-        # if partition > 2:
-        #    break
 
     if parallel:
         while True:
@@ -441,44 +565,46 @@ def convert_align_df_to_hic(align_df: AlignDf, hic_bed: Path, n_workers: int = 1
 
 
 def to_hic(df: AlignDf, max_fragment_id: int = 0) -> HicTxtDf:
-    res = []
-
     keep_segments = (
         df.query("pass_filter == True")
         .replace({"strand": {True: "0", False: "16"}})
         .astype({"strand": HicTxtDf.DTYPE["strand1"], "chrom": str})
     )
-    for x, (read_idx, read_df) in enumerate(keep_segments.groupby("read_idx", as_index=False)):
-
-        if max_fragment_id:
-            mask = read_df.fragment_id > max_fragment_id
-            if mask.any():
-                logger.warning("Overflow found in fragment id, removing {} records" % mask.sum())
-                read_df = read_df[~mask]
-
-        if len(read_df) <= 1:
-            continue
-        read_id = "{}:{}".format(read_df.read_name.values[0], read_idx)
-        rows = list(read_df.sort_values(["read_start"], ascending=True).itertuples())
-
-        for (pos1, pos2) in combinations(rows, 2):
-            if pos1.align_idx == pos2.align_idx:
-                raise ValueError
-            if pos1.fragment_id > pos2.fragment_id:
-                pos1, pos2 = pos2, pos1
-            res.append(
-                (
-                    read_id,
-                    pos1.strand,
-                    pos1.chrom,
-                    pos1.fragment_end,
-                    pos1.fragment_id - 1,
-                    pos2.strand,
-                    pos2.chrom,
-                    pos2.fragment_end,
-                    pos2.fragment_id - 1,
-                    pos1.mapping_quality,
-                    pos2.mapping_quality,
-                )
-            )
-    return pd.DataFrame(res, columns=HicTxtDf.DTYPE.keys()).astype(HicTxtDf.DTYPE)
+    if max_fragment_id:
+        mask = keep_segments.fragment_id > max_fragment_id
+        if mask.any():
+            logger.warning("Overflow found in fragment id, removing {} records".format(mask.sum()))
+            keep_segments = keep_segments[~mask]
+    keep_segments = keep_segments.sort_values(["read_idx", "read_start"], kind="mergesort")
+
+    idx1, idx2 = segment_pair_indices(keep_segments["read_idx"].values)
+    align_idx = keep_segments["align_idx"].values
+    if (align_idx[idx1] == align_idx[idx2]).any():
+        raise ValueError
+    fragment_id = keep_segments["fragment_id"].values.astype(np.int64)
+    # put the lower fragment id first
+    switch_order = fragment_id[idx1] > fragment_id[idx2]
+    first = np.where(switch_order, idx2, idx1)
+    second = np.where(switch_order, idx1, idx2)
+    read_id = (keep_segments["read_name"].astype(str) + ":" + keep_segments["read_idx"].astype(str)).to_numpy()
+    strand = keep_segments["strand"].to_numpy()
+    chrom = keep_segments["chrom"].to_numpy()
+    fragment_end = keep_segments["fragment_end"].values
+    mapping_quality = keep_segments["mapping_quality"].values
+    res = pd.DataFrame(
+        {
+            "readID": read_id[idx1],
+            "strand1": strand[first],
+            "chr1": chrom[first],
+            "pos1": fragment_end[first],
+            "frag1": fragment_id[first] - 1,
+            "strand2": strand[second],
+            "chr2": chrom[second],
+            "pos2": fragment_end[second],
+            "frag2": fragment_id[second] - 1,
+            "mapping_quality1": mapping_quality[first],
+            "mapping_quality2": mapping_quality[second],
+        },
+        columns=HicTxtDf.DTYPE.keys(),
+    )
+    return res.astype(HicTxtDf.DTYPE)
@@ -44,14 +44,15 @@ def filter_fastq(
     min_read_length: int = 50,
     max_read_length: int = 5000000,
     chunksize: int = 1000,
+    threads: int = 1,
 ):
 
     fastq_stream = Stream()
 
     filtered_stream = fastq_stream.map(filter_records, min_read_length, max_read_length)
 
-    pass_writer = FastqWriter(pass_fastq)
-    fail_writer = FastqWriter(fail_fastq)
+    pass_writer = FastqWriter(pass_fastq, threads=threads)
+    fail_writer = FastqWriter(fail_fastq, threads=threads)
 
     read_prog = ReadFilterProgress()
 
@@ -88,13 +89,12 @@ def filter_fastq(
 
 def filter_records(list_of_records, min_read_length, max_read_length):
 
-    df = (
-        pd.DataFrame([(_.name, len(_.sequence)) for _ in list_of_records], columns=["read_id", "read_length"])
-        .astype({"read_length": pd.np.uint32})
-        .eval("pass_filter = (@min_read_length <= read_length < @max_read_length)")
-    )
+    read_ids = [_.name for _ in list_of_records]
+    read_lengths = np.fromiter((len(_.sequence) for _ in list_of_records), dtype=np.uint32, count=len(list_of_records))
+    pass_filter = (min_read_length <= read_lengths) & (read_lengths < max_read_length)
+    df = pd.DataFrame({"read_id": read_ids, "read_length": read_lengths, "pass_filter": pass_filter})
     seq_strings = {True: [], False: []}
-    for seq, is_pass in zip(map(str, list_of_records), df["pass_filter"].values):
+    for seq, is_pass in zip(map(str, list_of_records), pass_filter.tolist()):
         seq_strings[is_pass].append(seq)
 
     return {"metadata": df, "pass": seq_strings[True], "fail": seq_strings[False]}
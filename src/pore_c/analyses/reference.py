@@ -1,16 +1,19 @@
 import re
+from functools import partial
+from logging import getLogger
 from pathlib import Path
-from time import sleep
-from typing import List, Pattern
+from typing import List, Pattern, Union
 
 import numpy as np
 import pandas as pd
 from pandas import DataFrame
 
 from pore_c.datasources import IndexedFasta
-from pore_c.model import FragmentDf
+from pore_c.model import FRAG_IDX_DTYPE, GENOMIC_COORD_DTYPE, FragmentDf
 from pore_c.utils import kmg_bases_to_int
 
+logger = getLogger(__name__)
+
 # complement translation table with support for regex punctuation
 COMPLEMENT_TRANS = str.maketrans("ACGTWSMKRYBDHVNacgtwsmkrybdhvn-)(][", "TGCAWSKMYRVHDBNtgcawskmyrvhdbn-()[]")
 
@@ -33,6 +36,39 @@ DEGENERATE_TRANS = str.maketrans(
     )
 )
 
+# each base is a bit in a 4-bit code, degenerate bases are the union of the bases they represent
+IUPAC_CODES = {
+    "A": 1,
+    "C": 2,
+    "G": 4,
+    "T": 8,
+    "M": 3,
+    "R": 5,
+    "W": 9,
+    "S": 6,
+    "Y": 10,
+    "K": 12,
+    "V": 7,
+    "H": 11,
+    "D": 13,
+    "B": 14,
+    "N": 15,
+}
+
+# lookup table from sequence byte to base code, anything other than ACGT has code 0 and never matches
+SEQ_CODE_LUT = np.zeros(256, dtype=np.uint8)
+for _base in "ACGT":
+    SEQ_CODE_LUT[ord(_base)] = SEQ_CODE_LUT[ord(_base.lower())] = IUPAC_CODES[_base]
+
+IUPAC_SITE_RE = re.compile(r"[{}]+".format("".join(IUPAC_CODES)), re.IGNORECASE)
+LITERAL_SITE_RE = re.compile(r"[ACGT]+", re.IGNORECASE)
+
+# number of sequence positions tested at a time by the site scanners
+IUPAC_SCAN_WINDOW = 1 << 22
+
+# a compiled regex, a literal site, a list of IUPAC site masks, a bin width or a Biopython enzyme class
+DigestMatcher = Union[Pattern, bytes, List[np.ndarray], int, type]
+
 
 def create_virtual_digest(
     reference_fasta: IndexedFasta,
@@ -44,41 +80,39 @@ def create_virtual_digest(
 ) -> FragmentDf:
     """Iterate over the sequences in a fasta file and find the match positions for the restriction fragment"""
 
-    parallel = n_workers > 1
-    if parallel:
-        from dask.distributed import Client, LocalCluster
-
-        cluster = LocalCluster(processes=True, n_workers=n_workers, threads_per_worker=1)
-        client = Client(cluster)
-
-    # convert the sequences to a dask bag
-    seq_bag = reference_fasta.to_dask()
+    reference_fasta.discover()
     chrom_dtype = pd.CategoricalDtype(reference_fasta._chroms, ordered=True)
     FragmentDf.set_dtype("chrom", chrom_dtype)
 
+    # compile the digest pattern once rather than once per chromosome
+    digest_matcher = create_digest_matcher(digest_type, digest_param)
+
+    # the chromosomes are digested independently, longest first so that the last few jobs are short
+    chrom_lengths = [chrom["length"] for chrom in reference_fasta.metadata["chroms"]]
+    chrom_indices = sorted(range(len(chrom_lengths)), key=lambda x: -chrom_lengths[x])
+    digest_chrom = partial(
+        _digest_chromosome,
+        reference_fasta,
+        digest_type=digest_type,
+        digest_matcher=digest_matcher,
+        chrom_dtype=chrom_dtype,
+    )
+    if n_workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        # each worker reads its chromosomes from the indexed fasta itself
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            chrom_dfs = list(executor.map(digest_chrom, chrom_indices))
+    else:
+        chrom_dfs = [digest_chrom(chrom_idx) for chrom_idx in chrom_indices]
+
     frag_df = (
-        pd.concat(
-            seq_bag.map(lambda x: (x["seqid"], x["seq"], digest_type, digest_param))
-            .starmap(create_fragment_dataframe)
-            .compute()
-        )
-        .astype({"chrom": chrom_dtype})
+        pd.concat(chrom_dfs, ignore_index=True)
         .sort_values(["chrom", "start"])
-        .assign(fragment_id=lambda x: np.arange(len(x), dtype=int) + 1)
+        .assign(fragment_id=lambda x: np.arange(1, len(x) + 1, dtype=FRAG_IDX_DTYPE))
         .fragmentdf.cast(subset=True)
     )
 
-    if parallel:
-        while True:
-            processing = client.processing()
-            still_running = [len(v) > 0 for k, v in processing.items()]
-            if any(still_running):
-                sleep(10)
-            else:
-                break
-        client.close()
-        cluster.close()
-
     # use pandas accessor extension
     frag_df.fragmentdf.assert_valid()
 
@@ -96,6 +130,18 @@ def create_virtual_digest(
     return frag_df
 
 
+def _digest_chromosome(
+    reference_fasta: IndexedFasta,
+    chrom_idx: int,
+    digest_type: str = None,
+    digest_matcher: DigestMatcher = None,
+    chrom_dtype: pd.CategoricalDtype = None,
+) -> DataFrame:
+    """Read a single chromosome from the fasta and find its fragments"""
+    (chrom,) = reference_fasta._get_partition(chrom_idx)
+    return create_fragment_dataframe(chrom["seqid"], chrom["seq"], digest_type, digest_matcher, chrom_dtype)
+
+
 def revcomp(seq: str) -> str:
     """Return the reverse complement of a string:
     """
@@ -107,11 +153,9 @@ def replace_degenerate(pattern: str) -> str:
     return pattern.translate(DEGENERATE_TRANS)
 
 
-def create_regex(pattern: str) -> Pattern:
-    """Takes a raw restriction digest site in the form of a regular expression
-    string and returns a regular expression object consisting of both forward
-    and reverse complement versions of the pattern"""
-
+def split_sites(pattern: str) -> List[str]:
+    """Split a restriction digest pattern into its alternative sites, in the order the
+    regex created by `create_regex` tries them"""
     site_raw = pattern.replace("(", " ").replace(")", " ").replace(" ", "").replace("|", " ").split()
     sites_raw = []
     for entry in sites_raw:
@@ -119,7 +163,18 @@ def create_regex(pattern: str) -> Pattern:
 
     sites_raw += site_raw
     if len(sites_raw) > 1:
-        fwd_rev_pattern = "(" + "|".join(sorted(list(set(sites_raw)))) + ")"
+        return sorted(list(set(sites_raw)))
+    return sites_raw
+
+
+def create_regex(pattern: str) -> Pattern:
+    """Takes a raw restriction digest site in the form of a regular expression
+    string and returns a regular expression object consisting of both forward
+    and reverse complement versions of the pattern"""
+
+    sites_raw = split_sites(pattern)
+    if len(sites_raw) > 1:
+        fwd_rev_pattern = "(" + "|".join(sites_raw) + ")"
     else:
         fwd_rev_pattern = "(" + sites_raw[0] + ")"
 
@@ -127,7 +182,7 @@ def create_regex(pattern: str) -> Pattern:
     fwd_rev_pattern = replace_degenerate(fwd_rev_pattern)
 
     try:
-        regex = re.compile(fwd_rev_pattern)
+        regex = re.compile(fwd_rev_pattern, re.IGNORECASE)
     except Exception as exc:
         raise ValueError(
             "Error compiling regex for pattern {}, redundance form: {}\n{}".format(pattern, fwd_rev_pattern, exc)
@@ -135,63 +190,176 @@ def create_regex(pattern: str) -> Pattern:
     return regex
 
 
-def find_fragment_intervals(digest_type: str, digest_param: str, seq: str) -> List[int]:
-    """Finds the start positions of all matches of the regex in the sequence"""
+def create_iupac_mask(site: str) -> np.ndarray:
+    """Convert a fixed-length site to an array of base code masks, one per position"""
+    return np.array([IUPAC_CODES[base] for base in site.upper()], dtype=np.uint8)
+
+
+def create_digest_matcher(digest_type: str, digest_param: str) -> DigestMatcher:
+    """Convert the digest parameter to the form used to scan the sequences:
+    a compiled regex (or a literal site or IUPAC masks for fixed-length sites), a bin width or a Biopython enzyme"""
     if digest_type == "regex":
-        regex = create_regex(digest_param)
-        positions = find_site_positions_regex(regex, seq)
+        # a single site without degenerate bases is found with a substring search, alternations of
+        # fixed-length sites (eg. "(GAATTC|GCGGCCGC)") are scanned with numpy, anything else falls
+        # back to the regex engine
+        sites = split_sites(digest_param)
+        if len(sites) == 1 and LITERAL_SITE_RE.fullmatch(sites[0]):
+            return sites[0].upper().encode("ascii")
+        if all(IUPAC_SITE_RE.fullmatch(site) for site in sites):
+            return [create_iupac_mask(site) for site in sites]
+        return create_regex(digest_param)
     elif digest_type == "bin":
-        bin_width = kmg_bases_to_int(digest_param)
-        positions = find_site_positions_bins(bin_width, seq)
+        return kmg_bases_to_int(digest_param)
+    elif digest_type == "enzyme":
+        from Bio import Restriction
+
+        enzyme = getattr(Restriction, digest_param, None)
+        if enzyme is None:
+            raise ValueError("Enzyme not found: {}".format(digest_param))
+        logger.debug("Enzyme {} has recognition site {}".format(digest_param, enzyme.site))
+        return enzyme
+    else:
+        raise ValueError("Unrecognised digest type: {}".format(digest_type))
+
+
+def find_fragment_intervals(digest_type: str, digest_param: Union[DigestMatcher, str], seq: str) -> List[int]:
+    """Finds the start positions of all matches of the regex in the sequence
+
+    The digest_param can either be the raw string from the command line or the output of `create_digest_matcher`.
+    """
+    if isinstance(digest_param, str):
+        digest_param = create_digest_matcher(digest_type, digest_param)
+    if digest_type == "regex" and isinstance(digest_param, bytes):
+        positions = find_site_positions_literal(digest_param, seq)
+    elif digest_type == "regex" and isinstance(digest_param, list):
+        positions = find_site_positions_iupac(digest_param, seq)
+    elif digest_type == "regex":
+        positions = find_site_positions_regex(digest_param, seq)
+    elif digest_type == "bin":
+        positions = find_site_positions_bins(digest_param, seq)
     elif digest_type == "enzyme":
         positions = find_site_positions_biopython(digest_param, seq)
     intervals = to_intervals(positions, len(seq))
     return intervals
 
 
-def to_intervals(positions: List[int], chrom_length: int):
+def to_intervals(positions: Union[List[int], np.ndarray], chrom_length: int):
+    positions = np.asarray(positions, dtype=np.int64)
     prefix, suffix = [], []
     if (len(positions) == 0) or positions[0] != 0:
         prefix = [0]
     if (len(positions) == 0) or positions[-1] != chrom_length:
         suffix = [chrom_length]
-    endpoints = np.array(prefix + positions + suffix)
+    endpoints = np.concatenate([prefix, positions, suffix]).astype(np.int64)
     return {"start": endpoints[:-1], "end": endpoints[1:]}
 
 
-def find_site_positions_bins(bin_width, seq: str) -> List[int]:
+def find_site_positions_bins(bin_width, seq: str) -> np.ndarray:
     """Mimic a fixed-width sequence digest by returning the positions of fixed-width bin boundaries"""
     if len(seq) < bin_width:
-        return []
+        return np.zeros(0, dtype=np.int64)
     else:
-        positions = list(range(0, len(seq), bin_width))
-        return positions
+        return np.arange(0, len(seq), bin_width, dtype=np.int64)
 
 
 def find_site_positions_regex(regex: Pattern, seq: str) -> List[int]:
     """Finds the start positions of all matches of the regex in the sequence"""
-    positions = [m.start() for m in regex.finditer(seq.upper())]
+    positions = [m.start() for m in regex.finditer(seq)]
+    return positions
+
+
+def find_site_positions_literal(site: bytes, seq: str) -> List[int]:
+    """Finds the start positions of all (non-overlapping) matches of an exact site in the sequence
+
+    Uses the C substring search, which skips through the sequence rather than testing every position. The
+    sequence is upper-cased a window at a time so that no copy of the whole chromosome is made.
+    """
+    site = site.decode("ascii")
+    site_length = len(site)
+    positions, next_start = [], 0
+    for window_start in range(0, len(seq), IUPAC_SCAN_WINDOW):
+        # each window overlaps the next by enough to find sites starting at the end of the window
+        window = seq[window_start : window_start + IUPAC_SCAN_WINDOW + site_length - 1].upper()  # noqa: E203
+        pos = window.find(site, max(next_start - window_start, 0))
+        while pos != -1 and pos < IUPAC_SCAN_WINDOW:
+            positions.append(window_start + pos)
+            next_start = window_start + pos + site_length
+            pos = window.find(site, pos + site_length)
     return positions
 
 
-def find_site_positions_biopython(enzyme: str, seq: str) -> List[int]:
-    from Bio import Restriction
+def find_site_positions_iupac(site_masks: Union[np.ndarray, List[np.ndarray]], seq: str) -> List[int]:
+    """Finds the start positions of all matches of one or more fixed-length sites in the sequence
+
+    The sequence is converted to base codes and each site position is tested against a window of
+    the sequence at once. Where several sites match at a position the first one in the list is used,
+    giving the same (non-overlapping) matches as the equivalent regex alternation.
+    """
+    if isinstance(site_masks, np.ndarray):
+        site_masks = [site_masks]
+    max_site_length = max(len(site_mask) for site_mask in site_masks)
+    positions, lengths = [], []
+    # scan in fixed-size windows so the temporary arrays don't scale with the chromosome length,
+    # each window overlaps the next by enough to test sites starting at the end of the window
+    for window_start in range(0, len(seq), IUPAC_SCAN_WINDOW):
+        window = seq[window_start : window_start + IUPAC_SCAN_WINDOW + max_site_length - 1]  # noqa: E203
+        codes = SEQ_CODE_LUT[np.frombuffer(window.encode("ascii"), dtype=np.uint8)]
+        # the length of the site matched at each position, 0 where nothing matches
+        match_length = np.zeros(min(IUPAC_SCAN_WINDOW, len(codes)), dtype=np.uint16)
+        for site_mask in site_masks:
+            site_length = len(site_mask)
+            num_starts = min(len(match_length), len(codes) - site_length + 1)
+            if num_starts <= 0:
+                continue
+            hits = match_length[:num_starts] == 0
+            for offset, mask in enumerate(site_mask):
+                hits &= (codes[offset : offset + num_starts] & mask) != 0  # noqa: E203
+            match_length[:num_starts][hits] = site_length
+        _positions = np.flatnonzero(match_length)
+        positions.append(_positions + window_start)
+        lengths.append(match_length[_positions])
+    positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.int64)
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.uint16)
+    if len(positions) > 1 and (np.diff(positions) < lengths[:-1]).any():
+        # regex matches can't overlap, keep the leftmost of any overlapping hits
+        keep, next_start = [], 0
+        for pos, length in zip(positions.tolist(), lengths.tolist()):
+            if pos >= next_start:
+                keep.append(pos)
+                next_start = pos + length
+        return keep
+    return positions.tolist()
+
+
+def find_site_positions_biopython(enzyme: type, seq: str) -> List[int]:
     from Bio.Seq import Seq
     from Bio.Alphabet.IUPAC import IUPACAmbiguousDNA
 
-    enz = getattr(Restriction, enzyme, None)
-    if enz is None:
-        raise ValueError("Enzyme not found: {}".format(enzyme))
     s = Seq(seq, IUPACAmbiguousDNA())
-    positions = [_ - 1 for _ in enz.search(s)]
+    positions = [_ - 1 for _ in enzyme.search(s)]
     return positions
 
 
-def create_fragment_dataframe(seqid: str, seq: str, digest_type: str, digest_param: str) -> DataFrame:
-    """Iterate over the sequences in a fasta file and find the match positions for the restriction fragment"""
-    intervals = (
-        DataFrame(find_fragment_intervals(digest_type, digest_param, seq))
-        .assign(chrom=seqid)
-        .eval("fragment_length = end - start")
-    )
-    return intervals
+def create_fragment_dataframe(
+    seqid: str,
+    seq: str,
+    digest_type: str,
+    digest_param: Union[DigestMatcher, str],
+    chrom_dtype: pd.CategoricalDtype = None,
+) -> DataFrame:
+    """Iterate over the sequences in a fasta file and find the match positions for the restriction fragment
+
+    The columns are created with their final dtypes, if `chrom_dtype` is set the chromosome is stored as
+    category codes rather than repeating the name on every fragment.
+    """
+    intervals = find_fragment_intervals(digest_type, digest_param, seq)
+    num_fragments = len(intervals["start"])
+    if chrom_dtype is None:
+        chrom = np.full(num_fragments, seqid, dtype=object)
+    else:
+        chrom = pd.Categorical.from_codes(
+            np.full(num_fragments, chrom_dtype.categories.get_loc(seqid), dtype=np.int32), dtype=chrom_dtype
+        )
+    start = intervals["start"].astype(GENOMIC_COORD_DTYPE)
+    end = intervals["end"].astype(GENOMIC_COORD_DTYPE)
+    return DataFrame({"start": start, "end": end, "chrom": chrom, "fragment_length": end - start})
@@ -64,6 +64,7 @@ class basePoreCCatalog(YAMLFileCatalog):
         }
         driver_lookup = {
             ".csv": "csv",
+            ".pairs.parquet": "pore_c.datasources.ParquetPairFile",
             ".parquet": "parquet",
             ".fq.gz": "pore_c.datasources.Fastq",
             ".fasta.gz": "pore_c.datasources.IndexedFasta",
@@ -135,7 +136,7 @@ class PairsFileCatalog(basePoreCCatalog):
     name = "pore_c_pairs"
     description = "An intake catalog file for a pairs format file"
 
-    _suffix_map = {"catalog": ".catalog.yaml", "pairs": ".pairs.gz"}
+    _suffix_map = {"catalog": ".catalog.yaml", "pairs": ".pairs.gz", "pairs_parquet": ".pairs.parquet"}
 
     @classmethod
     def create(cls, file_paths, *args, **kwds):
@@ -225,7 +226,7 @@ class ReferenceGenomeCatalog(basePoreCCatalog):
         "catalog": ".catalog.yaml",
         "fasta": ".fa.gz",
         "chromsizes": ".chromsizes",
-        "chrom_metadata": ".metadata.csv",
+        "chrom_metadata": ".metadata.parquet",
     }
 
     @classmethod
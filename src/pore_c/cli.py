@@ -1,15 +1,13 @@
-import json
 import logging
+import os
+import re
 from pathlib import Path
 
 import click
-from intake import open_catalog
 
-import pore_c.catalogs as catalogs
+logger = logging.getLogger("pore_c")
 
-from .settings import setup_logging
-
-logger = setup_logging()
+INPUT_REFGENOME_REGEX = re.compile(r"^(?P<stem>.+)\.(?P<ext>fasta|fa|fna)(?P<compression>\.gz|\.bgz)?$")
 
 
 class NaturalOrderGroup(click.Group):
@@ -23,17 +21,46 @@ class NaturalOrderGroup(click.Group):
 
 
 def command_line_json(ctx, param, value):
-    # TODO: add support for json from file
+    """Parse a json string, or the contents of a json file if the value is of the form @path"""
     if value is None:
         return {}
+    import json
+
     try:
-        res = json.loads(value)
-    except Exception as exc:  # noqa: F841
-        logger.exception("Not valid json")
-        raise
+        if value.startswith("@"):
+            with open(value[1:], "rb") as fh:
+                res = json.load(fh)
+        else:
+            res = json.loads(value)
+    except (OSError, ValueError) as exc:
+        raise click.BadParameter(f"Unable to read json from {value}: {exc}")
     return res
 
 
+def filename_matches_regex(regex):
+    """Create a callback that checks a filename against a compiled regex.
+
+    The match groups are stored in `ctx.meta` under the parameter name so that
+    the command doesn't need to repeat the match.
+    """
+
+    def _check_filename(ctx, param, value):
+        m = regex.match(os.path.basename(str(value)))
+        if not m:
+            raise click.BadParameter(f"Filename should match regex {regex.pattern}: {value}")
+        ctx.meta[f"{param.name}_parts"] = m.groups()
+        return value
+
+    return _check_filename
+
+
+def open_catalog(path):
+    """Open an intake catalog, intake is only imported by the commands that need it"""
+    from intake import open_catalog as _open_catalog
+
+    return _open_catalog(str(path))
+
+
 @click.group(cls=NaturalOrderGroup)
 @click.option("-v", "--verbosity", count=True, help="Increase level of logging information, eg. -vvv")
 @click.option("--quiet", is_flag=True, default=False, help="Turn off all logging")
@@ -42,15 +69,17 @@ def cli(verbosity, quiet):
 
     A suite of tools designed to analyse Oxford Nanopore reads with multiway chromatin contacts.
     """
+    from .settings import setup_logging
+
     if quiet:
-        logger.setLevel(logging.CRITICAL)
+        level = logging.CRITICAL
     elif verbosity > 0:
         LOG_LEVELS = [logging.CRITICAL, logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG]
         offset = 2
-        idx = min(len(LOG_LEVELS) - 1, offset + verbosity)
-        logger.setLevel(LOG_LEVELS[idx])
+        level = LOG_LEVELS[min(len(LOG_LEVELS) - 1, offset + verbosity)]
     else:
-        logger.setLevel(logging.INFO)
+        level = logging.INFO
+    setup_logging(level)
     logger.debug("Logger set up")
 
 
@@ -59,11 +88,25 @@ def refgenome():
     pass
 
 
-@refgenome.command(short_help="Pre-process a reference genome")
-@click.argument("reference_fasta", type=click.Path(exists=True))
+@refgenome.command("catalog", short_help="Pre-process a reference genome")
+@click.argument(
+    "reference_fasta", type=click.Path(exists=True), callback=filename_matches_regex(INPUT_REFGENOME_REGEX)
+)
 @click.argument("output_prefix")
 @click.option("--genome-id", type=str, help="An ID for this genome assembly")
-def catalog(reference_fasta, output_prefix, genome_id=None):
+@click.option(
+    "-t",
+    "--threads",
+    type=int,
+    default=min(8, os.cpu_count() or 1),
+    show_default=True,
+    help=(
+        "The number of threads used to compress the reference. More than one runs bgzip, "
+        "if bgzip isn't on the PATH the reference is compressed with a single thread"
+    ),
+)
+@click.pass_context
+def refgenome_catalog(ctx, reference_fasta, output_prefix, genome_id=None, threads=1):
     """Pre-process a reference genome for use by pore-C tools.
 
     This cool makes a bgzipped copy of the reference genome along with some ancillary
@@ -72,31 +115,31 @@ def catalog(reference_fasta, output_prefix, genome_id=None):
     """
     from pore_c.datasources import IndexedFasta
     from pore_c.catalogs import ReferenceGenomeCatalog
+    from pore_c.io import bgzip_copy, copy_to_bgzf
+    import gzip
+    import shutil
     import pandas as pd
-    import re
-    import subprocess as sp
     import pysam
 
-    fname_re = re.compile(r"(.+)\.(fasta|fa|fna)(\.gz)*")
-
     logger.info("Adding reference genome under prefix: {}".format(output_prefix))
     file_paths = ReferenceGenomeCatalog.generate_paths(output_prefix)
     path_kwds = {key: val for key, val in file_paths.items() if key != "catalog"}
     src_fasta = Path(str(reference_fasta))
     dest_fasta = path_kwds["fasta"]
+    stem, _, compression = ctx.meta["reference_fasta_parts"]
+    use_bgzip = threads > 1 and shutil.which("bgzip") is not None
+    if threads > 1 and not use_bgzip:
+        logger.warning("bgzip not found on the PATH, compressing the reference with a single thread")
 
-    parts_m = fname_re.match(src_fasta.name)
-    if not parts_m:
-        raise ValueError(f"Fasta file should match regex {fname_re}: {src_fasta}")
-    stem, _, compression = parts_m.groups()
-
-    if compression == ".gz":
-        comd = f"gunzip -cd {src_fasta} | bgzip > {dest_fasta}"
-    else:
-        comd = f"cat {src_fasta} | bgzip > {dest_fasta}"
     try:
-        logger.info(f"Creating bgzipped reference: {comd}")
-        sp.check_call(comd, shell=True)
+        logger.info(f"Creating bgzipped reference: {dest_fasta}")
+        if use_bgzip:
+            bgzip_copy(src_fasta, dest_fasta, threads=threads, gzipped=compression is not None)
+        elif compression is not None:
+            with gzip.open(src_fasta, "rb") as src:
+                copy_to_bgzf(src, dest_fasta)
+        else:
+            pysam.tabix_compress(str(src_fasta), str(dest_fasta), force=True)
     except Exception as exc:  # noqa: F841
         logger.exception(f"Error creating bgzipped reference: {dest_fasta}")
         raise
@@ -107,9 +150,10 @@ def catalog(reference_fasta, output_prefix, genome_id=None):
     ref_source = IndexedFasta(dest_fasta)
     ref_source.discover()
     chrom_lengths = {c["chrom"]: c["length"] for c in ref_source.metadata["chroms"]}
-    chrom_df = pd.DataFrame(ref_source.metadata["chroms"])[["chrom", "length"]]
-    chrom_df.to_csv(file_paths["chrom_metadata"], index=False)
-    chrom_df.to_csv(file_paths["chromsizes"], sep="\t", header=None, index=False)
+    # the chromsizes file is for external tools, the metadata table is typed for reading back in
+    file_paths["chromsizes"].write_text("".join(f"{chrom}\t{length}\n" for chrom, length in chrom_lengths.items()))
+    chrom_df = pd.DataFrame({"chrom": list(chrom_lengths.keys()), "length": list(chrom_lengths.values())})
+    chrom_df.to_parquet(str(file_paths["chrom_metadata"]), index=False)
     metadata = {"chrom_lengths": chrom_lengths, "genome_id": genome_id}
     rg_cat = ReferenceGenomeCatalog.create(file_paths, metadata, {})
     logger.info("Added reference genome: {}".format(str(rg_cat)))
@@ -119,7 +163,7 @@ def catalog(reference_fasta, output_prefix, genome_id=None):
 @click.argument("reference_catalog", type=click.Path(exists=True))
 @click.argument("cut_on")
 @click.argument("output_prefix")
-@click.option("-n", "--n_workers", help="The number of dask_workers to use", default=1)
+@click.option("-n", "--n_workers", help="The number of processes used to digest the chromosomes", default=1)
 def virtual_digest(reference_catalog, cut_on, output_prefix, n_workers):
     """
     Carry out a virtual digestion of the genome listed in a reference catalog.
@@ -142,10 +186,10 @@ def virtual_digest(reference_catalog, cut_on, output_prefix, n_workers):
       - degenerate site (ApoI): "regex:RAATY"
 
     """
-    from pore_c.catalogs import ReferenceGenomeCatalog, VirtualDigestCatalog
+    from pore_c.catalogs import VirtualDigestCatalog
     from pore_c.analyses.reference import create_virtual_digest
 
-    rg_cat = ReferenceGenomeCatalog(reference_catalog)
+    rg_cat = open_catalog(reference_catalog)
     digest_type, digest_param = cut_on.split(":")
     assert digest_type in ["bin", "enzyme", "regex"]
 
@@ -167,14 +211,25 @@ def to_hicref(virtual_digest_catalog, hicref):
     """
     Carry out a virtual digestion of the genome listed in a reference catalog.
     """
-    from pore_c.catalogs import VirtualDigestCatalog
-
-    vd_cat = VirtualDigestCatalog(virtual_digest_catalog)
-
-    frag_df = vd_cat.fragments.to_dask().compute()
-    with open(hicref, "w") as fh:
-        for chrom, endpoints in frag_df.groupby("chrom")["end"].agg(lambda x: " ".join(map(str, x))).items():
-            fh.write(f"{chrom} {endpoints}\n")
+    vd_cat = open_catalog(virtual_digest_catalog)
+
+    import numpy as np
+
+    # only the chromosome and endpoints are needed
+    frag_df = vd_cat.fragments(columns=["chrom", "end"]).read()
+    # the fragments are sorted by chromosome, so each chromosome is a slice of the endpoints
+    chroms = frag_df["chrom"].cat.categories
+    boundaries = np.searchsorted(frag_df["chrom"].cat.codes.values, np.arange(len(chroms) + 1))
+    endpoints = frag_df["end"].values
+    with open(hicref, "wb") as fh:
+        for chrom, lo, hi in zip(chroms, boundaries[:-1], boundaries[1:]):
+            if lo == hi:
+                continue
+            fh.write(f"{chrom} ".encode())
+            fh.flush()
+            # numpy formats the endpoints straight to the file
+            endpoints[lo:hi].tofile(fh, sep=" ")
+            fh.write(b"\n")
 
     logger.debug(f"Wrote hicRef file to {hicref}")
 
@@ -184,7 +239,7 @@ def reads():
     pass
 
 
-@reads.command(short_help="Create a catalog file for a set of reads")  # noqa: F811
+@reads.command("catalog", short_help="Create a catalog file for a set of reads")
 @click.argument("fastq", type=click.Path(exists=True))
 @click.argument("output_prefix")
 @click.option("--min-read-length", help="The minimum length read to run through porec", default=1)
@@ -193,22 +248,39 @@ def reads():
     help="The maximum length read to run through porec. Note that bwa mem can crash on very long reads",
     default=500000,
 )
-@click.option("--user-metadata", callback=command_line_json, help="Additional user metadata to associate with this run")
-def catalog(fastq, output_prefix, min_read_length, max_read_length, user_metadata):
+@click.option(
+    "--user-metadata",
+    callback=command_line_json,
+    help="Additional user metadata to associate with this run, either a json string or @path to a json file",
+)
+@click.option(
+    "-t",
+    "--threads",
+    type=int,
+    default=min(8, os.cpu_count() or 1),
+    show_default=True,
+    help="The number of threads bgzip uses to compress the output fastqs",
+)
+def reads_catalog(fastq, output_prefix, min_read_length, max_read_length, user_metadata, threads):
     """Preprocess a reference genome for use by pore_c tools
     """
+    import pore_c.catalogs as catalogs
     from pore_c.analyses.reads import filter_fastq
 
     file_paths = catalogs.RawReadCatalog.generate_paths(output_prefix)
     path_kwds = {key: val for key, val in file_paths.items() if key != "catalog"}
     summary = filter_fastq(
-        input_fastq=fastq, min_read_length=min_read_length, max_read_length=max_read_length, **path_kwds
+        input_fastq=fastq,
+        min_read_length=min_read_length,
+        max_read_length=max_read_length,
+        threads=threads,
+        **path_kwds,
     )
 
     catalog = catalogs.RawReadCatalog.create(file_paths, {"summary_stats": summary}, user_metadata)
     logger.info("Created catalog for results: {}".format(catalog))
 
-    c1 = open_catalog(str(file_paths["catalog"]))
+    c1 = open_catalog(file_paths["catalog"])
     logger.info(c1)
 
 
@@ -221,18 +293,38 @@ def alignments():
 @click.argument("input_bam", type=click.Path(exists=True))
 @click.argument("virtual_digest_catalog", type=click.Path(exists=True))
 @click.argument("output_prefix")
-@click.option("-n", "--n_workers", help="The number of dask_workers to use", default=1)
-@click.option("--chunksize", help="Number of reads per processing chunk", default=50000)
-def parse(input_bam, virtual_digest_catalog, output_prefix, n_workers, chunksize):
+@click.option("-n", "--n_workers", help="The number of processes used to filter the alignments", default=1)
+@click.option(
+    "--chunksize",
+    type=int,
+    default=None,
+    help="Number of reads per processing chunk, by default this is set based on the available memory",
+)
+@click.option(
+    "-t",
+    "--threads",
+    "--bam-threads",
+    "threads",
+    type=int,
+    default=min(8, os.cpu_count() or 1),
+    show_default=True,
+    help=(
+        "The number of htslib threads to use to decompress the bam. These are separate from the "
+        "processing workers and only help with BGZF compressed input, not SAM or uncompressed BAM"
+    ),
+)
+def parse(input_bam, virtual_digest_catalog, output_prefix, n_workers, chunksize, threads):
     """Filter the read-sorted alignments in INPUT_BAM and save the results under OUTPUT_PREFIX
 
     """
+    import pore_c.catalogs as catalogs
     from pore_c.analyses.alignments import parse_alignment_bam
 
     file_paths = catalogs.AlignmentDfCatalog.generate_paths(output_prefix)
 
-    vd_cat = open_catalog(str(virtual_digest_catalog))
-    fragment_df = vd_cat.fragments.read()
+    vd_cat = open_catalog(virtual_digest_catalog)
+    # only the fragment intervals are needed to assign alignments to fragments
+    fragment_df = vd_cat.fragments(columns=["chrom", "start", "end", "fragment_id"]).read()
     final_stats = parse_alignment_bam(
         input_bam,
         fragment_df,
@@ -243,6 +335,7 @@ def parse(input_bam, virtual_digest_catalog, output_prefix, n_workers, chunksize
         read_summary=file_paths["read_summary"],
         n_workers=n_workers,
         chunksize=chunksize,
+        threads=threads,
     )
     metadata = {"final_stats": final_stats}
     file_paths["virtual_digest"] = Path(virtual_digest_catalog)
@@ -258,10 +351,11 @@ def parse(input_bam, virtual_digest_catalog, output_prefix, n_workers, chunksize
 def to_salsa_bed(align_catalog, salsa_bed, n_workers):
     """Covert the alignment table to Salsa bed format.
 
+    If SALSA_BED ends in .parquet the records are written as a parquet table.
     """
     from pore_c.analyses.pairs import convert_align_df_to_salsa
 
-    adf_cat = open_catalog(str(align_catalog))
+    adf_cat = open_catalog(align_catalog)
     align_df = adf_cat.alignment.to_dask()
 
     logger.info(f"Converting alignments in {align_catalog} to salsa2 bed format {salsa_bed}")
@@ -277,17 +371,18 @@ def to_salsa_bed(align_catalog, salsa_bed, n_workers):
 def to_hic_txt(align_catalog, hic_txt, n_workers):
     """Covert the alignment table to hic text format.
 
+    If HIC_TXT ends in .parquet the records are written as an unsorted parquet table.
     """
     from pore_c.analyses.pairs import convert_align_df_to_hic
 
-    adf_cat = open_catalog(str(align_catalog))
+    adf_cat = open_catalog(align_catalog)
     align_df = adf_cat.alignment.to_dask()
 
     vd_cat = adf_cat.virtual_digest
     # FIXFIX: some invalid fragment ids are appearing in the alignment table
     # we need to fix at source, but for now we need to filter these records
     # out of the hic.txt files
-    max_fragment_id = vd_cat.fragments.to_dask()["fragment_id"].max().compute()
+    max_fragment_id = vd_cat.fragments(columns=["fragment_id"]).to_dask()["fragment_id"].max().compute()
 
     logger.info(f"Converting alignments in {align_catalog} to hic text format {hic_txt}")
     res = convert_align_df_to_hic(align_df, Path(hic_txt), n_workers=n_workers, max_fragment_id=max_fragment_id)
@@ -305,35 +400,51 @@ def pairs():
 @click.argument("output_prefix")
 @click.option("-n", "--n_workers", help="The number of dask_workers to use", default=1)
 def from_alignment_table(align_catalog, output_prefix, n_workers):
+    import pore_c.catalogs as catalogs
     from pore_c.analyses.pairs import convert_align_df_to_pairs
 
     file_paths = catalogs.PairsFileCatalog.generate_paths(output_prefix)
 
-    adf_cat = open_catalog(str(align_catalog))
+    adf_cat = open_catalog(align_catalog)
     rg_cat = adf_cat.virtual_digest.refgenome_catalog
     chrom_lengths = rg_cat.metadata["chrom_lengths"]
     genome_id = rg_cat.metadata["genome_id"]
     align_df = adf_cat.alignment.to_dask()
     # TODO: return number of pairs written
-    metadata = convert_align_df_to_pairs(align_df, chrom_lengths, genome_id, file_paths["pairs"], n_workers=n_workers)
+    metadata = convert_align_df_to_pairs(
+        align_df,
+        chrom_lengths,
+        genome_id,
+        file_paths["pairs"],
+        n_workers=n_workers,
+        pair_parquet=file_paths["pairs_parquet"],
+    )
 
+    # the parquet table is only written if there were some pairs
+    if not file_paths["pairs_parquet"].exists():
+        del file_paths["pairs_parquet"]
     file_paths["aligmentdf_cat"] = Path(align_catalog)
     pair_cat = catalogs.PairsFileCatalog.create(file_paths, metadata, {})
     logger.info(str(pair_cat))
 
 
-@pairs.command(help="Convert from an alignment table to pairs format")
+@pairs.command(help="Bin a pairs file into a contact matrix")
 @click.argument("pairs_catalog", type=click.Path(exists=True))
 @click.argument("output_prefix")
 @click.option("-r", "--resolution", help="The bin width of the resulting matrix", default=1000)
 @click.option("-n", "--n_workers", help="The number of dask_workers to use", default=1)
 def to_matrix(pairs_catalog, output_prefix, resolution, n_workers):
+    import pore_c.catalogs as catalogs
     from pore_c.analyses.pairs import convert_pairs_to_matrix
 
     file_paths = catalogs.MatrixCatalog.generate_paths(output_prefix)
-    pairs_cat = open_catalog(str(pairs_catalog))
+    pairs_cat = open_catalog(pairs_catalog)
 
-    ds = pairs_cat.pairs
+    # the parquet table only needs the position columns decoded, older catalogs only have the pairs text
+    if "pairs_parquet" in pairs_cat:
+        ds = pairs_cat.pairs_parquet
+    else:
+        ds = pairs_cat.pairs
     metadata = convert_pairs_to_matrix(ds, resolution=resolution, n_workers=n_workers, coo=file_paths["coo"])
     metadata["resolution"] = resolution
 
@@ -353,6 +464,7 @@ def matrix():
 @click.option("-r", "--resolution", help="The resolution to do the correlation at.", default=1000000)
 def correlate(x_mcool, y_mcool, output_prefix, resolution):
     from pore_c.analyses.matrix import correlate
+    import pore_c.catalogs as catalogs
     from cooler import Cooler
 
     file_paths = catalogs.MatrixCorrelationCatalog.generate_paths(output_prefix)
@@ -360,17 +472,18 @@ def correlate(x_mcool, y_mcool, output_prefix, resolution):
     x_cool = Cooler(str(x_mcool) + f"::/resolutions/{resolution}")
     y_cool = Cooler(str(y_mcool) + f"::/resolutions/{resolution}")
 
-    x_chrom_names = set(x_cool.chromnames)
-    y_chrom_names = set(y_cool.chromnames)
+    # the chromosome names are read when the coolers are opened, the usual case is that they match
+    x_chrom_names = x_cool.chromnames
+    y_chrom_names = y_cool.chromnames
 
     if x_chrom_names != y_chrom_names:
-        x_not_y = x_chrom_names - y_chrom_names
-        y_not_x = y_chrom_names - x_chrom_names
+        x_not_y = set(x_chrom_names).difference(y_chrom_names)
+        y_not_x = set(y_chrom_names).difference(x_chrom_names)
         if x_not_y and y_not_x:
             raise ValueError(f"Chromosomes are not sub/supersets x:{x_not_y}, y:{y_not_x}")
         elif x_not_y:
             logger.warning(f"Extra chromosomes in x, will not be included in calculations: {x_not_y}")
-        else:
+        elif y_not_x:
             logger.warning(f"Extra chromosomes in y, will not be included in calculations: {y_not_x}")
 
     metadata = correlate(
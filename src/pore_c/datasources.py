@@ -1,14 +1,20 @@
-from typing import Iterator, List, Tuple
+import io
+import json
+from logging import getLogger
+from typing import List, Tuple
 
 import dask
 import numpy as np
 import pandas as pd
 from intake.source.base import DataSource, Schema
-from pysam import (AlignedSegment, AlignmentFile, FastaFile, FastxFile,
+from pysam import (FREVERSE, FSECONDARY, FSUPPLEMENTARY, FUNMAP,
+                   AlignedSegment, AlignmentFile, FastaFile, FastxFile,
                    TabixFile, asTuple)
 
 from pore_c.model import BamEntryDf, GenomeIntervalDf, PairDf
 
+logger = getLogger(__name__)
+
 
 class Fastq(DataSource):
     name = "fastq"
@@ -70,6 +76,8 @@ class IndexedFasta(DataSource):
         )
 
     def _get_partition(self, i):
+        # the source may have been sent to a dask worker, make sure the fasta is open
+        self._load_metadata()
         chrom = self._chroms[i]
         return [{"seqid": chrom, "seq": self._dataset.fetch(chrom)}]
 
@@ -82,7 +90,8 @@ class IndexedFasta(DataSource):
         from dask import bag as db
 
         self._load_metadata()
-        return db.from_delayed([dask.delayed(self._get_partition(i)) for i in range(self.npartitions)])
+        # delay the fetch itself so that sequences are read by the workers in parallel
+        return db.from_delayed([dask.delayed(self._get_partition)(i) for i in range(self.npartitions)])
 
     def _close(self):
         # close any files, sockets, etc
@@ -132,20 +141,35 @@ class IndexedPairFile(DataSource):
         )
 
     def _get_partition(self, i, usecols=None):
+        self._load_metadata()
         pid = self._partition_ids[i]
         columns = list(self._dtype.keys())
-        it = self._dataset.querys2D("{}:{}-{}|*".format(*pid), 1)
-        df = pd.DataFrame(list(it), columns=columns).astype(self._dtype)
-        if usecols:
-            return df.loc[:, usecols].copy()
-        else:
-            return df
-
-    def to_dask(self, *args, **kwds):
+        usecols = usecols if usecols else columns
+        dtype = {c: self._dtype[c] for c in usecols}
+        lines = ["\t".join(row) for row in self._dataset.querys2D("{}:{}-{}|*".format(*pid), 1)]
+        if not lines:
+            return pd.DataFrame([], columns=usecols).astype(dtype)
+        # let the C parser convert the integer fields rather than casting python strings column by column
+        df = pd.read_csv(
+            io.StringIO("\n".join(lines)),
+            sep="\t",
+            header=None,
+            names=columns,
+            usecols=usecols,
+            dtype=dtype,
+            na_filter=False,
+        )
+        return df.loc[:, usecols]
+
+    def to_dask(self, usecols=None):
         from dask import dataframe as dd
 
         self._load_metadata()
-        return dd.from_delayed([dask.delayed(self._get_partition(i, *args, **kwds)) for i in range(self.npartitions)])
+        # the partitions only hold the selected columns so the meta has to match
+        meta = {c: self._dtype[c] for c in usecols} if usecols else self._dtype
+        return dd.from_delayed(
+            [dask.delayed(self._get_partition)(i, usecols=usecols) for i in range(self.npartitions)], meta=meta
+        )
 
     def read(self):
         raise NotImplementedError
@@ -158,6 +182,66 @@ class IndexedPairFile(DataSource):
             self._dataset.close()
 
 
+class ParquetPairFile(DataSource):
+    name = "parquet_pairfile"
+    version = "0.1.0"
+    container = "dataframe"
+    partition_access = True
+    description = "A pairs table stored as parquet, each row group is a partition"
+
+    def __init__(self, urlpath, metadata=None):
+        self._urlpath = urlpath
+        self._dataset = None
+        self._dtype = None
+        self._chroms = None
+        super(ParquetPairFile, self).__init__(metadata=metadata)
+
+    def _open_dataset(self):
+        from pyarrow import parquet as pq
+
+        # the chromosome columns are read as categoricals straight from the parquet dictionary pages
+        # rather than building a string per pair
+        self._dataset = pq.ParquetFile(self._urlpath, read_dictionary=["chr1", "chr2"])
+
+    def _get_schema(self):
+        if self._dataset is None:
+            self._open_dataset()
+        # the chromosome sizes are stored in the schema metadata in place of the pairs header
+        self._chroms = json.loads(self._dataset.schema_arrow.metadata[b"chromsizes"])
+        assert set(self._dataset.schema_arrow.names) == set(PairDf.DTYPE.keys())
+        self._dtype = PairDf.DTYPE.copy()
+        self._dtype["chr1"] = self._dtype["chr2"] = "category"
+        return Schema(
+            datashape=None,
+            dtype=self._dtype,
+            shape=(self._dataset.metadata.num_rows, len(self._dtype)),
+            npartitions=self._dataset.num_row_groups,
+            extra_metadata={},
+        )
+
+    def _get_partition(self, i, usecols=None):
+        self._load_metadata()
+        # only the requested columns are decoded from the row group
+        return self._dataset.read_row_group(i, columns=usecols).to_pandas()
+
+    def to_dask(self, usecols=None):
+        from dask import dataframe as dd
+
+        self._load_metadata()
+        # the partitions only hold the selected columns so the meta has to match
+        meta = {c: self._dtype[c] for c in usecols} if usecols else self._dtype
+        return dd.from_delayed(
+            [dask.delayed(self._get_partition)(i, usecols=usecols) for i in range(self.npartitions)], meta=meta
+        )
+
+    def read(self):
+        self._load_metadata()
+        return self._dataset.read().to_pandas()
+
+    def _close(self):
+        self._dataset = None
+
+
 class IndexedBedFile(DataSource):
     name = "indexed_bedfile"
     version = "0.1.0"
@@ -224,16 +308,24 @@ class NameSortedBamSource(DataSource):
     partition_access = False
     description = "Readname-sorted BAM of poreC alignments"
 
-    def __init__(self, urlpath, include_unmapped=True, metadata=None):
+    def __init__(self, urlpath, include_unmapped=True, threads=1, metadata=None):
         self._urlpath = urlpath
         self._include_unmapped = include_unmapped
+        self._threads = threads
         self._af = None
         self._dtype = None
         super(NameSortedBamSource, self).__init__(metadata=metadata)
 
     def _open_dataset(self):
-        # TODO check that bam file has namesorted in header
-        self._af = AlignmentFile(self._urlpath)
+        # extra htslib threads are used to decompress the BGZF blocks
+        self._af = AlignmentFile(self._urlpath, threads=self._threads)
+        sort_order = self._af.header.to_dict().get("HD", {}).get("SO", None)
+        if sort_order != "queryname":
+            logger.warning(
+                "BAM header sort order is {}, alignments must be grouped by read name: {}".format(
+                    sort_order, self._urlpath
+                )
+            )
 
     def _get_schema(self):
         if self._af is None:
@@ -249,78 +341,107 @@ class NameSortedBamSource(DataSource):
         return self._schema.dtype["chrom"]
 
     @staticmethod
-    def _group_by_read(align_iter: Iterator[AlignedSegment]) -> Iterator[List[Tuple[int, int, AlignedSegment]]]:
-        """Iterate over alignments in name-sorted bam file grouping by read"""
-        current_read_name = None
-        read_idx = 0
-        aligns = []
-        for align_idx, align in enumerate(align_iter):
-            if current_read_name is None:
-                current_read_name = align.query_name
-                aligns.append((read_idx, align_idx, align))
-            elif current_read_name == align.query_name:
-                aligns.append((read_idx, align_idx, align))
-            else:
-                yield aligns
-                read_idx += 1
-                current_read_name = align.query_name
-                aligns = [(read_idx, align_idx, align)]
-        yield aligns
-
-    def _align_to_tuple(self, align_data):
-        read_idx, align_idx, align = align_data
-        if align.is_unmapped:
-            align_cat = "unmapped"
-            chrom, start, end, align_score = "NULL", 0, 0, 0
-            read_length = align.query_length
-        else:
-            chrom, start, end = (align.reference_name, align.reference_start, align.reference_end)
-            read_length = align.infer_read_length()
-            align_score = align.get_tag("AS")
-            if align.is_secondary:
-                align_cat = "secondary"
-            elif align.is_supplementary:
-                align_cat = "supplementary"
+    def _aligns_to_df(
+        align_data: List[Tuple[int, int, AlignedSegment]], chrom_dtype: pd.CategoricalDtype
+    ) -> pd.DataFrame:
+        """Pull the fields of a batch of alignments into preallocated column arrays
+
+        The chromosome is stored as the reference id, which is also its code in `chrom_dtype`
+        """
+        num_aligns = len(align_data)
+        read_idx = np.empty(num_aligns, dtype=BamEntryDf.DTYPE["read_idx"])
+        align_idx = np.empty(num_aligns, dtype=BamEntryDf.DTYPE["align_idx"])
+        mapping_type = np.empty(num_aligns, dtype=np.int8)
+        chrom = np.empty(num_aligns, dtype=np.int32)
+        start = np.zeros(num_aligns, dtype=BamEntryDf.DTYPE["start"])
+        end = np.zeros(num_aligns, dtype=BamEntryDf.DTYPE["end"])
+        strand = np.empty(num_aligns, dtype=bool)
+        read_name = np.empty(num_aligns, dtype=object)
+        read_length = np.empty(num_aligns, dtype=BamEntryDf.DTYPE["read_length"])
+        read_start = np.empty(num_aligns, dtype=BamEntryDf.DTYPE["read_start"])
+        read_end = np.empty(num_aligns, dtype=BamEntryDf.DTYPE["read_end"])
+        mapping_quality = np.empty(num_aligns, dtype=BamEntryDf.DTYPE["mapping_quality"])
+        score = np.zeros(num_aligns, dtype=BamEntryDf.DTYPE["score"])
+
+        # codes into BamEntryDf.DTYPE["mapping_type"]
+        UNMAPPED, PRIMARY, SUPPLEMENTARY, SECONDARY = range(4)
+        null_chrom = chrom_dtype.categories.get_loc("NULL")
+        for idx, (_read_idx, _align_idx, align) in enumerate(align_data):
+            read_idx[idx] = _read_idx
+            align_idx[idx] = _align_idx
+            # test the flag bits directly rather than going through the is_* properties
+            flag = align.flag
+            if flag & FUNMAP:
+                mapping_type[idx] = UNMAPPED
+                chrom[idx] = null_chrom
+                read_length[idx] = align.query_length
             else:
-                align_cat = "primary"
-        return (
-            read_idx,
-            align_idx,
-            align_cat,
-            chrom,
-            start,
-            end,
-            not align.is_reverse,
-            align.query_name,
-            read_length,
-            align.query_alignment_start,
-            align.query_alignment_end,
-            align.mapq,
-            align_score,
+                chrom[idx] = align.reference_id
+                start[idx] = align.reference_start
+                end[idx] = align.reference_end
+                read_length[idx] = align.infer_read_length()
+                score[idx] = align.get_tag("AS")
+                if flag & FSECONDARY:
+                    mapping_type[idx] = SECONDARY
+                elif flag & FSUPPLEMENTARY:
+                    mapping_type[idx] = SUPPLEMENTARY
+                else:
+                    mapping_type[idx] = PRIMARY
+            strand[idx] = not flag & FREVERSE
+            read_name[idx] = align.query_name
+            read_start[idx] = align.query_alignment_start
+            read_end[idx] = align.query_alignment_end
+            mapping_quality[idx] = align.mapping_quality
+
+        return pd.DataFrame(
+            {
+                "read_idx": read_idx,
+                "align_idx": align_idx,
+                "mapping_type": pd.Categorical.from_codes(mapping_type, dtype=BamEntryDf.DTYPE["mapping_type"]),
+                "chrom": pd.Categorical.from_codes(chrom, dtype=chrom_dtype),
+                "start": start,
+                "end": end,
+                "strand": strand,
+                "read_name": read_name,
+                "read_length": read_length,
+                "read_start": read_start,
+                "read_end": read_end,
+                "mapping_quality": mapping_quality,
+                "score": score,
+            }
         )
 
     def read_chunked(self, chunksize=10000, yield_aligns=False, max_chunks=None):
         """Read the bam into a dataframe in chunks, yield those chunks
         """
         self._load_metadata()
-        from toolz import partition_all
 
-        BamEntryDf.set_dtype("chrom", self.get_chrom_dtype())
+        chrom_dtype = self.get_chrom_dtype()
+        BamEntryDf.set_dtype("chrom", chrom_dtype)
         align_iter = self._af.fetch(until_eof=self._include_unmapped)
-        columns = list(self._schema.dtype.keys())
-        for chunk_idx, chunk in enumerate(partition_all(chunksize, self._group_by_read(align_iter))):
-            aligns = [a for read_aligns in chunk for a in read_aligns]
-            df = (
-                pd.DataFrame([self._align_to_tuple(a) for a in aligns], columns=columns)
-                .astype(BamEntryDf.DTYPE)
-                .bamdf.cast(fillna=True, subset=True)
-            )
-            if yield_aligns:
-                yield (aligns, df)
-            else:
-                yield (df)
-            if max_chunks and chunk_idx == max_chunks - 1:
-                break
+
+        def _to_chunk(aligns):
+            df = self._aligns_to_df(aligns, chrom_dtype).astype(BamEntryDf.DTYPE).bamdf.cast(fillna=True, subset=True)
+            return (aligns, df) if yield_aligns else df
+
+        # group by read name in the same pass that batches the alignments, a chunk is emitted
+        # when the first alignment of the read after the last one in the chunk is seen
+        chunk_idx, num_reads, read_idx, current_read_name, aligns = 0, 0, -1, None, []
+        for align_idx, align in enumerate(align_iter):
+            read_name = align.query_name
+            if read_name != current_read_name:
+                if num_reads == chunksize:
+                    yield _to_chunk(aligns)
+                    chunk_idx += 1
+                    if max_chunks and chunk_idx == max_chunks:
+                        return
+                    num_reads, aligns = 0, []
+                current_read_name = read_name
+                read_idx += 1
+                num_reads += 1
+            aligns.append((read_idx, align_idx, align))
+        if aligns:
+            yield _to_chunk(aligns)
 
     def _close(self):
         if self._af is not None:
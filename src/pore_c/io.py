@@ -1,5 +1,8 @@
+import os
 import subprocess as sp
 from logging import getLogger
+from queue import Queue
+from threading import Thread
 
 import pyarrow as pa
 from pyarrow import parquet as pq
@@ -7,6 +10,128 @@ from pyarrow import parquet as pq
 logger = getLogger(__name__)
 
 
+def copy_to_bgzf(src_fh, dest_path, chunk_size=1 << 20, max_queued_chunks=4):
+    """Copy a (decompressing) file handle into a BGZF file.
+
+    The source is read in a background thread so that decompression overlaps with the BGZF
+    compression in the calling thread, zlib releases the GIL for both.
+    """
+    from pysam import BGZFile
+
+    # htslib crashes rather than raising if the output can't be opened
+    dest_dir = os.path.dirname(os.path.abspath(str(dest_path)))
+    if not os.path.isdir(dest_dir):
+        raise IOError("Output directory does not exist: {}".format(dest_dir))
+
+    chunks = Queue(maxsize=max_queued_chunks)
+    errors = []
+
+    def _reader():
+        try:
+            while True:
+                chunk = src_fh.read(chunk_size)
+                chunks.put(chunk)
+                if not chunk:
+                    break
+        except Exception as exc:
+            errors.append(exc)
+            chunks.put(b"")
+
+    reader = Thread(target=_reader, daemon=True)
+    reader.start()
+    with BGZFile(str(dest_path), "wb") as dest_fh:
+        while True:
+            chunk = chunks.get()
+            if not chunk:
+                break
+            dest_fh.write(chunk)
+    reader.join()
+    if errors:
+        raise errors[0]
+
+
+def bgzip_copy(src_path, dest_path, threads=1, gzipped=False):
+    """Compress a file into a BGZF file using `bgzip --threads`.
+
+    BGZF blocks are compressed independently so bgzip can spread them over several threads. If
+    `gzipped` is set the source is decompressed with gzip on the way in.
+    """
+    bgzip_comd = ["bgzip", "--threads", str(threads), "-c"]
+    with open(dest_path, "wb") as dest_fh:
+        if gzipped:
+            gunzip = sp.Popen(["gzip", "-dc", str(src_path)], stdout=sp.PIPE)
+            try:
+                sp.check_call(bgzip_comd, stdin=gunzip.stdout, stdout=dest_fh)
+            finally:
+                gunzip.stdout.close()
+                returncode = gunzip.wait()
+            if returncode != 0:
+                raise sp.CalledProcessError(returncode, gunzip.args)
+        else:
+            sp.check_call(bgzip_comd + [str(src_path)], stdout=dest_fh)
+
+
+class ThreadedWriter(object):
+    """Wrap a writer so that its calls run in a background thread.
+
+    Batches are passed to the writer in order through a bounded queue, so that encoding and
+    compressing one batch overlaps with preparing the next in the calling thread. Errors raised
+    by the writer are re-raised in the calling thread on the next call or on close, in which case
+    the wrapped writer is aborted rather than left open.
+    """
+
+    def __init__(self, writer, max_queued_batches=4):
+        self._writer = writer
+        self._batches = Queue(maxsize=max_queued_batches)
+        self._errors = []
+        self._aborted = False
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._batches.get()
+            if batch is None:
+                break
+            if self._errors or self._aborted:
+                # keep draining the queue so the calling thread doesn't block
+                continue
+            try:
+                self._writer(batch)
+            except Exception as exc:
+                self._errors.append(exc)
+
+    def _stop(self):
+        if self._thread.is_alive():
+            self._batches.put(None)
+            self._thread.join()
+
+    def _abort_writer(self):
+        abort = getattr(self._writer, "abort", None)
+        if abort is not None:
+            abort()
+        else:
+            self._writer.close()
+
+    def __call__(self, batch):
+        if self._errors:
+            raise self._errors[0]
+        self._batches.put(batch)
+
+    def close(self):
+        self._stop()
+        if self._errors:
+            self._abort_writer()
+            raise self._errors[0]
+        return self._writer.close()
+
+    def abort(self):
+        """Stop the background thread, dropping any queued batches, and abort the wrapped writer"""
+        self._aborted = True
+        self._stop()
+        self._abort_writer()
+
+
 class HicTxtFileWriter(object):
     def __init__(self, output_path):
         self._output_path = output_path
@@ -48,7 +173,7 @@ class SalsaBedFileWriter(object):
 
 
 class PairFileWriter(object):
-    def __init__(self, output_path, chrom_sizes, genome_assembly, columns=None):
+    def __init__(self, output_path, chrom_sizes, genome_assembly, columns=None, threads=1):
         self._output_path = output_path
         if self._output_path.suffix == ".gz":
             self._raw_output_path = self._output_path.with_suffix("")
@@ -59,6 +184,8 @@ class PairFileWriter(object):
         self._chrom_sizes = chrom_sizes
         self._genome_assembly = genome_assembly
         self._columns = columns
+        # number of compression threads used by bgzip
+        self._threads = threads
         self._fh = None
         self._string_template = "%s\n" % ("\t".join(["{}" for c in self._columns]))
 
@@ -68,21 +195,29 @@ class PairFileWriter(object):
         lines.append("#columns: {}".format(" ".join(self._columns)))
         self._fh.write("{}\n".format("\n".join(lines)))
 
+    def _open(self):
+        self._fh = open(self._raw_output_path, "w")
+        self._write_header()
+
     def __call__(self, pair_df):
         assert len(pair_df.columns) == len(self._columns)
         if self._fh is None:
-            self._fh = open(self._raw_output_path, "w")
-            self._write_header()
+            self._open()
         pair_df.to_csv(self._fh, header=None, sep="\t", index=False)
 
     def close(self):
+        if self._fh is None:
+            # no pairs, still write a valid file with just the header
+            self._open()
         self._fh.close()
         # TODO: this could all be cleaned up a bit
         if self._sort_and_compress:
             logger.info("Sorting and compressing: {}".format(self._output_path))
             # FIXFIX: the --nproc 1 is so that this command will run on OSX where the default sort command
             # doesn't support the --parallel option
-            comd = "pairtools sort --nproc 1 {} | bgzip > {}".format(self._raw_output_path, self._output_path)
+            comd = "pairtools sort --nproc 1 {} | bgzip --threads {} > {}".format(
+                self._raw_output_path, self._threads, self._output_path
+            )
             logger.info("Running command: {}".format(comd))
             sp.check_call(comd, shell=True)
             sp.check_call(["pairix", str(self._output_path)])
@@ -91,8 +226,10 @@ class PairFileWriter(object):
 
 
 class FastqWriter(object):
-    def __init__(self, output_path):
+    def __init__(self, output_path, threads=1):
         self._output_path = output_path
+        # number of compression threads used by bgzip
+        self._threads = threads
         if self._output_path.suffix == ".gz":
             self._raw_output_path = self._output_path.with_suffix("")
             self._compress = True
@@ -119,29 +256,63 @@ class FastqWriter(object):
         # TODO: this could all be cleaned up a bit
         if self._compress:
             logger.info("Compressing {} using bgzip".format(self._raw_output_path))
-            sp.check_call(["bgzip", str(self._raw_output_path)])
+            sp.check_call(["bgzip", "--threads", str(self._threads), str(self._raw_output_path)])
 
 
 class TableWriter(object):
-    def __init__(self, path):
+    def __init__(self, path, row_group_size=None, compression="zstd", compression_level=None, metadata=None):
         self.path = path
+        # if no row group size is set each batch is written as a single row group
+        self._row_group_size = row_group_size
+        self._compression = compression
+        self._compression_level = compression_level
+        # extra key/value pairs to store in the parquet schema metadata
+        self._metadata = metadata
         self._writer = None
         self._schema = None
         self._counter = 0
+        self._rows_written = 0
+        # write to a temporary file and rename on close so the output path never holds a partial table
+        self._tmp_path = "{}.tmp".format(self.path)
 
     def write(self, df):
         table = pa.Table.from_pandas(df, preserve_index=False, schema=self._schema)
         if self._writer is None:
-            self._writer = pq.ParquetWriter(self.path, schema=table.schema)
+            if self._metadata:
+                table = table.replace_schema_metadata({**(table.schema.metadata or {}), **self._metadata})
+            self._writer = pq.ParquetWriter(
+                self._tmp_path,
+                schema=table.schema,
+                compression=self._compression,
+                compression_level=self._compression_level,
+                use_dictionary=True,
+            )
             self._schema = table.schema
         try:
-            self._writer.write_table(table)
+            self._writer.write_table(table, row_group_size=self._row_group_size or max(len(table), 1))
         except Exception as exc:
             raise IOError("Error writing batch {} to {}:\n{}\n{}".format(self._counter, self.path, df.head(), exc))
         self._counter += 1
+        self._rows_written += len(df)
 
     def __call__(self, *args, **kwds):
         return self.write(*args, **kwds)
 
     def close(self):
+        if self._writer is None:
+            logger.warning("No data written to {}".format(self.path))
+            return 0
         self._writer.close()
+        os.replace(self._tmp_path, self.path)
+        return self._rows_written
+
+    def abort(self):
+        """Discard the partially written table"""
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception as exc:
+                logger.debug("Error closing {} after a failure: {}".format(self._tmp_path, exc))
+            self._writer = None
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
@@ -1,4 +1,4 @@
-from typing import Dict, NewType
+from typing import Dict, NewType, Union
 
 import numpy as np
 import pandas as pd
@@ -22,6 +22,7 @@ FRAG_IDX_DTYPE = np.uint32
 READ_IDX_DTYPE = np.uint32
 ALIGN_IDX_DTYPE = np.uint32
 PERCENTAGE_DTYPE = np.float32
+CONTACT_COUNT_DTYPE = np.uint32  # number of contacts in a single matrix pixel
 
 
 class basePorecDf(object):
@@ -321,7 +322,7 @@ class GenomeIntervalDf(object):
 
     def as_ncls_dict(self) -> Dict[Chrom, NCLS]:
         res = {}
-        for chrom, chrom_df in self._obj.groupby("chrom"):
+        for chrom, chrom_df in self._obj.groupby("chrom", observed=True):
             res[chrom] = NCLS(
                 chrom_df.start.values.astype(np.int64),
                 chrom_df.end.values.astype(np.int64),
@@ -329,11 +330,19 @@ class GenomeIntervalDf(object):
             )
         return res
 
+    def build_index(self) -> "GenomeIntervalIndex":
+        """Build the lookup structures used to find overlaps with these intervals.
+
+        Pass the result to `overlap` in place of the dataframe to query the same intervals many times (eg.
+        the fragments that every batch of alignments is overlapped with).
+        """
+        return GenomeIntervalIndex(self._obj)
+
     def assign(self, other: "GenomeIntervalDf"):
         """Assign intervals in this dataframe to the first overlapping interval in other"""
         tgt = other.ginterval.as_ncls_dict()
         overlaps = []
-        for chrom, chrom_df in self._obj.groupby("chrom"):
+        for chrom, chrom_df in self._obj.groupby("chrom", observed=True):
             if chrom not in tgt:
                 continue
             self_indices, target_indices = tgt[chrom].first_overlap_both(
@@ -349,46 +358,69 @@ class GenomeIntervalDf(object):
             raise ValueError(overlaps[overlaps.index.duplicated(keep="both")])
         return overlaps.reindex(index=self._obj.index)
 
-    def overlap(self, other: "GenomeIntervalDf", calculate_lengths: bool = True):
-        """Find all overlapping intervals between this dataframe and 'other'"""
-        self_cols = ["chrom", "start", "end", self.index_name]
+    def overlap(
+        self,
+        other: Union["GenomeIntervalDf", "GenomeIntervalIndex"],
+        calculate_lengths: bool = True,
+        min_overlap_length: int = None,
+    ):
+        """Find all overlapping intervals between this dataframe and 'other'
+
+        `other` can be an index from `build_index` to avoid rebuilding it when the same intervals are queried
+        repeatedly. If `min_overlap_length` is set, overlaps shorter than that are dropped before the rest of the
+        columns are gathered.
+        """
+        tgt = other if isinstance(other, GenomeIntervalIndex) else other.ginterval.build_index()
         other_rename = {"start": "other_start", "end": "other_end"}
-        if self.index_name == other.ginterval.index_name:
-            other_rename[other.ginterval.index_name] = "other_" + other.ginterval.index_name
+        if self.index_name == tgt.index_name:
+            other_rename[tgt.index_name] = "other_" + tgt.index_name
         else:
-            other_rename[other.ginterval.index_name] = other.ginterval.index_name
-        tgt = other.ginterval.as_ncls_dict()
-        overlaps = []
-        for chrom, chrom_df in self._obj.groupby("chrom"):
+            other_rename[tgt.index_name] = tgt.index_name
+        starts = self._obj["start"].values.astype(np.int64)
+        ends = self._obj["end"].values.astype(np.int64)
+        # find the overlaps for each chromosome as (row number in self, row number in other) then gather all
+        # the columns for every chromosome at once
+        self_rows, target_rows = [], []
+        for chrom, rows in self._obj.groupby("chrom", observed=True).indices.items():
             if chrom not in tgt:
                 continue
-            self_indices, target_indices = tgt[chrom].all_overlaps_both(
-                chrom_df.start.values.astype(np.int64),
-                chrom_df.end.values.astype(np.int64),
-                chrom_df.index.values.astype(np.int64),
-            )
-            overlap_df = (
-                chrom_df.reindex(self_indices).reset_index()
-                # .rename(columns={'index': 'query_idx'})
-                .loc[:, self_cols]
-            ).join(
-                other.reindex(target_indices).reset_index().rename(columns=other_rename).loc[:, other_rename.values()]
-            )
-            if calculate_lengths:
-                overlap_df = (
-                    overlap_df.assign(
-                        overlap_start=lambda x: np.where(x.other_start > x.start, x.other_start, x.start).astype(int),
-                        overlap_end=lambda x: np.where(x.other_end < x.end, x.other_end, x.end).astype(int),
-                    )
-                    .eval("overlap_length = overlap_end - overlap_start")
-                    .eval("perc_of_self = (100.0 * overlap_length) / (end - start)")
-                    .eval("perc_of_other = (100.0 * overlap_length) / (other_end - other_start)")
+            _self_rows, _target_rows = tgt.all_overlaps(chrom, starts[rows], ends[rows], rows)
+            self_rows.append(_self_rows)
+            target_rows.append(_target_rows)
+        if not self_rows:
+            return None
+        self_rows = np.concatenate(self_rows)
+        target_rows = np.concatenate(target_rows)
+        start, end = self._obj["start"].values[self_rows], self._obj["end"].values[self_rows]
+        other_start, other_end = tgt.start[target_rows], tgt.end[target_rows]
+        if calculate_lengths or min_overlap_length is not None:
+            # plain array arithmetic on the typed columns, rather than parsing an expression for each one
+            overlap_start = np.maximum(start, other_start).astype(np.int64)
+            overlap_end = np.minimum(end, other_end).astype(np.int64)
+            if min_overlap_length is not None:
+                keep = (overlap_end - overlap_start) >= min_overlap_length
+                self_rows, target_rows, start, end, other_start, other_end, overlap_start, overlap_end = (
+                    _[keep]
+                    for _ in (self_rows, target_rows, start, end, other_start, other_end, overlap_start, overlap_end)
                 )
-            overlaps.append(overlap_df)
-        if overlaps:
-            res = pd.concat(overlaps, ignore_index=True).astype({self.index_name: np.uint64})
-        else:
-            res = None
+            overlap_length = overlap_end - overlap_start
+        res = pd.DataFrame(
+            {
+                "chrom": self._obj["chrom"].values.take(self_rows),
+                "start": start,
+                "end": end,
+                self.index_name: self._obj.index.values[self_rows].astype(np.uint64),
+                other_rename["start"]: other_start,
+                other_rename["end"]: other_end,
+                other_rename[tgt.index_name]: tgt.labels[target_rows],
+            }
+        )
+        if calculate_lengths:
+            res["overlap_start"] = overlap_start
+            res["overlap_end"] = overlap_end
+            res["overlap_length"] = overlap_length
+            res["perc_of_self"] = (100.0 * overlap_length) / (end - start)
+            res["perc_of_other"] = (100.0 * overlap_length) / (other_end - other_start)
         return res
 
     @classmethod
@@ -406,3 +438,53 @@ class GenomeIntervalDf(object):
             dfs.append(_df)
         df = pd.concat(dfs, ignore_index=True).reset_index().rename(columns={"index": "bin_id"})
         return df[["chrom", "start", "end", "bin_id"]]
+
+
+class GenomeIntervalIndex(object):
+    """Lookup structures for finding the intervals of a GenomeIntervalDf that overlap a set of queries.
+
+    Created by `GenomeIntervalDf.build_index`, this is a snapshot of the intervals at that point so build a new
+    one if the dataframe is modified.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.index_name = df.ginterval.index_name
+        self.start = df["start"].values.copy()
+        self.end = df["end"].values.copy()
+        self.labels = df.index.values.copy()
+        # the start, end and row number of the intervals on each chromosome, in dataframe order
+        self._chrom_arrays = {
+            chrom: (self.start[rows], self.end[rows], rows)
+            for chrom, rows in df.groupby("chrom", observed=True).indices.items()
+        }
+        # intervals that are sorted and non-overlapping within each chromosome (eg. fragments or bins) can be
+        # searched with a binary search on the starts and ends
+        self.sorted_disjoint = all(
+            (starts[1:] >= ends[:-1]).all() and (starts <= ends).all()
+            for starts, ends, _ in self._chrom_arrays.values()
+        )
+        self._ncls = {}
+
+    def __contains__(self, chrom: Chrom) -> bool:
+        return chrom in self._chrom_arrays
+
+    def _ncls_index(self, chrom: Chrom) -> NCLS:
+        # only needed if the intervals overlap, built the first time each chromosome is queried
+        if chrom not in self._ncls:
+            starts, ends, rows = self._chrom_arrays[chrom]
+            self._ncls[chrom] = NCLS(starts.astype(np.int64), ends.astype(np.int64), rows.astype(np.int64))
+        return self._ncls[chrom]
+
+    def all_overlaps(self, chrom: Chrom, starts: np.ndarray, ends: np.ndarray, indices: np.ndarray):
+        """The (query index, target row number) pairs for all intervals on a chromosome overlapping the queries"""
+        if not self.sorted_disjoint:
+            return self._ncls_index(chrom).all_overlaps_both(starts, ends, indices)
+        # with sorted, non-overlapping targets the overlaps of each query are a contiguous run of targets: from
+        # the first target ending after the query start to the last one starting before the query end
+        tgt_starts, tgt_ends, tgt_rows = self._chrom_arrays[chrom]
+        # search with the dtype of the targets so they aren't converted on every call
+        first = np.searchsorted(tgt_ends, starts.astype(tgt_ends.dtype), side="right")
+        num_overlaps = np.clip(np.searchsorted(tgt_starts, ends.astype(tgt_starts.dtype), side="left") - first, 0, None)
+        run_starts = np.cumsum(num_overlaps) - num_overlaps
+        target_pos = np.arange(num_overlaps.sum()) + np.repeat(first - run_starts, num_overlaps)
+        return np.repeat(indices, num_overlaps), tgt_rows[target_pos].astype(np.int64)
@@ -1,4 +1,5 @@
 import logging
+from copy import deepcopy
 from logging.config import dictConfig
 
 BASE_CONFIG = {
@@ -18,6 +19,11 @@ BASE_CONFIG = {
 }
 
 
-def setup_logging():
-    dictConfig(BASE_CONFIG)
+def setup_logging(level=None):
+    """Configure logging, optionally overriding the level of the pore_c logger"""
+    config = BASE_CONFIG
+    if level is not None:
+        config = deepcopy(BASE_CONFIG)
+        config["loggers"]["pore_c"]["level"] = level
+    dictConfig(config)
     return logging.getLogger("pore_c")
@@ -1,3 +1,4 @@
+import os
 import re
 
 from tqdm import tqdm
@@ -43,3 +44,33 @@ def kmg_bases_to_int(value: str) -> int:
     value = int(m.group(1))
     exponent = {"k": 1e3, "m": 1e6, "g": 1e9}[m.group(2).lower()]
     return value * int(exponent)
+
+
+def available_memory():
+    """The number of bytes of physical memory not in use, or None if the platform doesn't report it
+
+    This counts free pages only so it underestimates what could be reclaimed from the page cache.
+    """
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        return None
+
+
+def memory_based_chunksize(
+    row_bytes: int,
+    mem_fraction: float = 0.05,
+    in_flight: int = 1,
+    min_size: int = 10000,
+    max_size: int = 500000,
+    default: int = 100000,
+) -> int:
+    """Pick a number of rows per chunk so that the `in_flight` chunks held in memory at once use
+    roughly `mem_fraction` of available memory. The result is always clamped to [min_size, max_size],
+    `default` is used if the available memory can't be found"""
+    available = available_memory()
+    if available is None:
+        size = default
+    else:
+        size = int(mem_fraction * available / (row_bytes * max(1, in_flight)))
+    return max(min_size, min(max_size, size))
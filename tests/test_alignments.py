@@ -60,3 +60,21 @@ def test_overlaps(query, target, overlaps):
         res = set((tuple(v) for v in olap_df[['index', 'other_index', 'overlap_length']].values))
     assert(res == set(overlaps))
 
+
+@pytest.mark.parametrize("chunksize", [1, 3, 100])
+def test_mapping_quality_filter(namesorted_align_filename, chunksize):
+    from pore_c.datasources import NameSortedBamSource
+    from pore_c.analyses.alignments import filter_read_alignments
+
+    fragment_df = (
+        GenomeIntervalDf.fixed_width_bins({"21": 46709983, "22": 50818468}, 5000)
+        .rename(columns={"bin_id": "fragment_id"})
+        .assign(fragment_id=lambda x: x.fragment_id + 1, fragment_length=lambda x: x.end - x.start)
+        .set_index("fragment_id")
+    )
+    fragment_df["chrom"] = pd.Categorical(fragment_df["chrom"], categories=["21", "22"], ordered=True)
+    source = NameSortedBamSource(str(namesorted_align_filename), metadata={})
+    for align_df in source.read_chunked(chunksize=chunksize):
+        res = filter_read_alignments(align_df, fragment_df)["alignment_table"]
+        low_mq = (res.mapping_type != "unmapped") & (res.mapping_quality <= 1)
+        assert (res.loc[low_mq, "reason"] == "low_mq").all()
@@ -1,2 +1,28 @@
+import subprocess
+import sys
+
 import pytest
 
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "intake",
+        "pysam",
+        "pyarrow",
+        "pandas",
+        "dask",
+        "cooler",
+        "bokeh",
+        "pore_c.analyses",
+        "pore_c.catalogs",
+        "pore_c.datasources",
+        "pore_c.io",
+        "pore_c.model",
+        "pore_c.settings",
+    ],
+)
+def test_cli_import_is_lazy(module):
+    # heavy dependencies should only be imported by the subcommands that need them
+    comd = "import sys, pore_c.cli; sys.exit(int({!r} in sys.modules))".format(module)
+    assert subprocess.call([sys.executable, "-c", comd]) == 0
@@ -0,0 +1,69 @@
+import time
+
+import pandas as pd
+import pytest
+from pyarrow import parquet as pq
+
+from pore_c.io import TableWriter, ThreadedWriter
+
+
+class FailingWriter(object):
+    def __init__(self):
+        self.aborted = False
+
+    def __call__(self, df):
+        raise ValueError("bad batch")
+
+    def close(self):
+        return 0
+
+    def abort(self):
+        self.aborted = True
+
+
+def test_threaded_writer_raises_on_close():
+    inner = FailingWriter()
+    writer = ThreadedWriter(inner)
+    writer(pd.DataFrame({"a": [1]}))
+    with pytest.raises(ValueError):
+        writer.close()
+    assert inner.aborted
+
+
+def test_threaded_writer_raises_on_call():
+    inner = FailingWriter()
+    writer = ThreadedWriter(inner)
+    # the error from the background thread surfaces on one of the following calls
+    with pytest.raises(ValueError):
+        for _ in range(1000):
+            writer(pd.DataFrame({"a": [1]}))
+            time.sleep(0.01)
+
+
+def test_threaded_writer_abort_removes_table(tmp_path):
+    path = tmp_path / "table.parquet"
+    writer = ThreadedWriter(TableWriter(path))
+    writer(pd.DataFrame({"a": [1, 2]}))
+    writer.abort()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_table_writer_renames_on_close(tmp_path):
+    path = tmp_path / "table.parquet"
+    writer = TableWriter(path, metadata={"key": "value"})
+    writer(pd.DataFrame({"a": [1, 2]}))
+    writer(pd.DataFrame({"a": [3]}))
+    assert not path.exists()
+    assert [p.name for p in tmp_path.iterdir()] == ["table.parquet.tmp"]
+    assert writer.close() == 3
+    assert [p.name for p in tmp_path.iterdir()] == ["table.parquet"]
+    table = pq.ParquetFile(path)
+    assert table.num_row_groups == 2
+    assert table.schema_arrow.metadata[b"key"] == b"value"
+    assert pd.read_parquet(path)["a"].tolist() == [1, 2, 3]
+
+
+def test_table_writer_empty(tmp_path):
+    writer = TableWriter(tmp_path / "table.parquet")
+    assert writer.close() == 0
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,74 @@
+import json
+from itertools import combinations, groupby
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pore_c.analyses.pairs import segment_pair_indices
+
+
+@pytest.mark.parametrize("read_idx", [[], [0], [0, 0], [0, 1, 1, 2, 2, 2], [5, 5, 5, 5, 3, 7, 7]])
+def test_segment_pair_indices(read_idx):
+    expected = []
+    offset = 0
+    for _, group in groupby(read_idx):
+        num_segments = len(list(group))
+        expected.extend(combinations(range(offset, offset + num_segments), 2))
+        offset += num_segments
+    idx1, idx2 = segment_pair_indices(np.array(read_idx))
+    assert list(zip(idx1, idx2)) == expected
+
+
+def _pair_df(pairs):
+    from pore_c.model import PairDf
+
+    chr1, pos1, chr2, pos2 = zip(*pairs)
+    num_pairs = len(pairs)
+    return pd.DataFrame(
+        {
+            "readID": ["read{}".format(i) for i in range(num_pairs)],
+            "chr1": chr1,
+            "pos1": pos1,
+            "chr2": chr2,
+            "pos2": pos2,
+            "strand1": "+",
+            "strand2": "-",
+            "pair_type": "DJ",
+            "frag1": 1,
+            "frag2": 2,
+            "align_idx1": 0,
+            "align_idx2": 1,
+            "distance_on_read": 10,
+        }
+    ).astype(PairDf.DTYPE)
+
+
+def test_parquet_pairs_to_matrix(tmp_path):
+    from pore_c.analyses.pairs import convert_pairs_to_matrix
+    from pore_c.datasources import ParquetPairFile
+    from pore_c.io import TableWriter
+
+    chrom_lengths = {"chrA": 1000, "chrB": 500}
+    pair_path = tmp_path / "test.pairs.parquet"
+    writer = TableWriter(pair_path, metadata={"chromsizes": json.dumps(chrom_lengths)})
+    writer(_pair_df([("chrA", 50, "chrA", 150), ("chrA", 50, "chrA", 160)]))
+    writer(_pair_df([("chrA", 950, "chrB", 10), ("chrB", 420, "chrB", 499)]))
+    assert writer.close() == 4
+
+    ds = ParquetPairFile(str(pair_path))
+    ds.discover()
+    assert ds.npartitions == 2
+    assert ds._chroms == chrom_lengths
+    partition = ds._get_partition(1, usecols=["chr1", "pos1", "chr2", "pos2"])
+    assert list(partition.columns) == ["chr1", "pos1", "chr2", "pos2"]
+    assert isinstance(partition["chr1"].dtype, pd.CategoricalDtype)
+    assert isinstance(partition["chr2"].dtype, pd.CategoricalDtype)
+    assert partition["chr2"].tolist() == ["chrB", "chrB"]
+
+    coo_path = tmp_path / "test.coo.txt"
+    summary = convert_pairs_to_matrix(ds, resolution=100, coo=coo_path)
+    assert summary["total_contacts"] == 4
+    # chrA has bins 0-9 and chrB has bins 10-14
+    coo = pd.read_csv(coo_path, sep="\t", header=None, names=["bin1_id", "bin2_id", "count"])
+    assert coo.values.tolist() == [[0, 1, 2], [9, 10, 1], [14, 14, 1]]
@@ -0,0 +1,36 @@
+import random
+
+import pytest
+
+from pore_c.analyses.reference import (create_digest_matcher,
+                                       create_iupac_mask, create_regex,
+                                       find_site_positions_iupac,
+                                       find_site_positions_literal,
+                                       find_site_positions_regex)
+
+
+@pytest.mark.parametrize("site", ["AAGCTT", "GATC", "GCCNNNNNGGC", "RAATY", "AAAA", "aagctt"])
+def test_iupac_scan_matches_regex(site):
+    rng = random.Random(42)
+    seq = "".join(rng.choice("ACGTacgtN") for _ in range(20000))
+    assert find_site_positions_iupac(create_iupac_mask(site), seq) == find_site_positions_regex(
+        create_regex(site), seq
+    )
+
+
+@pytest.mark.parametrize("pattern", ["(GAATTC|GCGGCCGC)", "(GATCA|GATC)", "(AA|AAA)", "(RAATY|GCCNNNNNGGC)"])
+def test_iupac_alternation_matches_regex(pattern):
+    rng = random.Random(42)
+    seq = "".join(rng.choice("ACGTacgtN") for _ in range(20000))
+    site_masks = create_digest_matcher("regex", pattern)
+    assert isinstance(site_masks, list)
+    assert find_site_positions_iupac(site_masks, seq) == find_site_positions_regex(create_regex(pattern), seq)
+
+
+@pytest.mark.parametrize("site", ["AAGCTT", "GATC", "AAAA", "aagctt"])
+def test_literal_scan_matches_regex(site):
+    rng = random.Random(42)
+    seq = "".join(rng.choice("ACGTacgtN") for _ in range(20000))
+    site_bytes = create_digest_matcher("regex", site)
+    assert isinstance(site_bytes, bytes)
+    assert find_site_positions_literal(site_bytes, seq) == find_site_positions_regex(create_regex(site), seq)
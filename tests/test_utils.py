@@ -9,3 +9,29 @@ from pore_c.utils import kmg_bases_to_int
 ])
 def test_kmgbases_to_int(kmg_str, val):
     assert(kmg_bases_to_int(kmg_str) == val)
+
+
+def test_memory_based_chunksize():
+    from pore_c.utils import memory_based_chunksize
+
+    assert 10 <= memory_based_chunksize(1024, min_size=10, max_size=100) <= 100
+    assert memory_based_chunksize(2 ** 60, min_size=10, max_size=100) == 10
+
+
+def test_memory_based_chunksize_fallback(monkeypatch):
+    import pore_c.utils
+    from pore_c.utils import memory_based_chunksize
+
+    monkeypatch.setattr(pore_c.utils, "available_memory", lambda: None)
+    assert memory_based_chunksize(1024, min_size=10, max_size=100, default=1000) == 100
+    assert memory_based_chunksize(1024, min_size=10, max_size=100, default=1) == 10
+
+
+def test_memory_based_chunksize_in_flight(monkeypatch):
+    import pore_c.utils
+    from pore_c.utils import memory_based_chunksize
+
+    monkeypatch.setattr(pore_c.utils, "available_memory", lambda: 100 * 2 ** 20)
+    single = memory_based_chunksize(1024, mem_fraction=0.05, min_size=1, max_size=10 ** 9)
+    assert single == 5120
+    assert memory_based_chunksize(1024, mem_fraction=0.05, in_flight=17, min_size=1, max_size=10 ** 9) == single // 17